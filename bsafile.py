@@ -1,22 +1,80 @@
 #!/usr/bin/env python2
 
 import argparse
-from collections import defaultdict, namedtuple, OrderedDict
+from array import array
+from collections import defaultdict, deque, namedtuple, OrderedDict
+import errno
+import hashlib
+from fnmatch import fnmatchcase
+import mmap
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
-from struct import unpack, pack, error
+import pickle
+from Queue import Queue
+from struct import unpack, pack, error, Struct
 from StringIO import StringIO
+import sys
+import threading
 import zlib
 
+from stringtables import default_cache_dir
+
 BSAHeader = namedtuple('BSAHeader', 'file_id , version, offset, archive_flags, folder_count, file_count, total_folder_name_length, total_file_name_length, file_flags')
 #, folder_records, file_record_blocks, file_name_block, files')
 Folder = namedtuple('Folder', 'name, name_hash, count, offset, files')
 File = namedtuple('File', 'name, name_hash, size, offset')
 
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HeaderStruct = Struct('<4s8I')
+FolderRecord = {103: Struct('<QII'),
+                104: Struct('<QII'),
+                105: Struct('<QIIQ')} # hash, count, padding, offset
+FileRecord = Struct('<QII')
+U32 = Struct('<I')
+
+# archive_flags
+ARCHIVE_DIRECTORY_NAMES = 0x1
+ARCHIVE_FILE_NAMES = 0x2
+ARCHIVE_COMPRESSED = 0x4
+ARCHIVE_EMBED_NAMES = 0x100 # version 104 and later
+
+# File.size
+FILE_SIZE_COMPRESSED = 0x40000000 # inverts ARCHIVE_COMPRESSED for the file
+FILE_SIZE_MASK = 0x3fffffff
+
+# file_flags, by extension
+FileFlags = {'.nif': 0x1, '.dds': 0x2, '.xml': 0x4, '.wav': 0x8,
+             '.mp3': 0x10, '.ogg': 0x10, '.lip': 0x10, '.fuz': 0x10,
+             '.txt': 0x20, '.html': 0x20, '.bat': 0x20, '.scc': 0x20,
+             '.spt': 0x40, '.tex': 0x80, '.fnt': 0x80}
+FILE_FLAGS_MISC = 0x100
+
 
 def get_options():
     parser = argparse.ArgumentParser(description='ff')
     parser.add_argument('-f', '--bsafile', dest='bsafile', type=str)
-    parser.add_argument('-w', '--write_to', dest='write_to', type=str)
+    parser.add_argument('-w', '--write_to', dest='write_to', type=str, default='.')
+    parser.add_argument('-d', '--folders', dest='folders', nargs='+', default=['*'],
+                        help='folder name patterns, e.g. meshes\\critters\\*')
+    parser.add_argument('-n', '--names', dest='names', nargs='+', default=['*'],
+                        help='file name patterns, e.g. *.nif')
+    parser.add_argument('-l', '--list', dest='list', action='store_true')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int)
+    parser.add_argument('-c', '--create', dest='create', type=str,
+                        help='write BSAFILE from the files below this directory')
+    parser.add_argument('--archive-version', dest='archive_version', type=int, default=104)
+    parser.add_argument('--uncompressed', dest='compress', action='store_false')
+    parser.add_argument('--embed-names', dest='embed_names', action='store_true')
     return parser.parse_args()
 
 def parse_header(bsafile):
@@ -76,6 +134,591 @@ def load(filename):
         return header, folders, file_names, files
 
 
+class BSAArchive(object):
+    """Memory-mapped archive. Folder and file records are looked up by
+    binary search over the sorted hash tables; names are only read when
+    asked for."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as bsafile:
+            self._map = mmap.mmap(bsafile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = BSAHeader._make(HeaderStruct.unpack_from(self._map, 0))
+        self.version = self.header.version
+        if self.version not in FolderRecord:
+            raise ValueError('Unsupported BSA version {}'.format(self.version))
+        self._folder_record = FolderRecord[self.version]
+        self._folders_offset = self.header.offset
+        self._folder_starts = None # global index of each folder's first file
+        self._name_offsets = None # offset of every file name, by global index
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.header.file_count
+
+    def _bisect(self, name_hash, offset, count, record):
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            h = record.unpack_from(self._map, offset + mid * record.size)[0]
+            if h < name_hash:
+                lo = mid + 1
+            elif h > name_hash:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def folder_record(self, index):
+        record = self._folder_record.unpack_from(self._map,
+                                                 self._folders_offset + index * self._folder_record.size)
+        name_hash, count, offset = record[0], record[1], record[-1]
+        return Folder._make([None, name_hash, count, offset, None])
+
+    def find_folder(self, name_hash):
+        """Index of the folder with name_hash, or None."""
+        return self._bisect(name_hash, self._folders_offset,
+                            self.header.folder_count, self._folder_record)
+
+    def _block_offset(self, folder):
+        # The folder offset counts the file name block as if it came first.
+        return folder.offset - self.header.total_file_name_length
+
+    def _file_records_offset(self, folder):
+        offset = self._block_offset(folder)
+        if self.header.archive_flags & ARCHIVE_DIRECTORY_NAMES:
+            offset += 1 + ord(self._map[offset])
+        return offset
+
+    def folder_name(self, index):
+        if not self.header.archive_flags & ARCHIVE_DIRECTORY_NAMES:
+            return None
+        offset = self._block_offset(self.folder_record(index))
+        length = ord(self._map[offset])
+        return self._map[offset+1:offset+length] # bzstring
+
+    def file_record(self, folder_index, index, name=None):
+        folder = self.folder_record(folder_index)
+        name_hash, size, offset = FileRecord.unpack_from(
+            self._map, self._file_records_offset(folder) + index * FileRecord.size)
+        return File._make([name, name_hash, size, offset])
+
+    def find_file(self, folder_index, name_hash):
+        """Index within the folder of the file with name_hash, or None."""
+        folder = self.folder_record(folder_index)
+        return self._bisect(name_hash, self._file_records_offset(folder),
+                            folder.count, FileRecord)
+
+    def _build_name_offsets(self):
+        header = self.header
+        starts = array('I')
+        total = 0
+        for i in range(header.folder_count):
+            starts.append(total)
+            total += self.folder_record(i).count
+        self._folder_starts = starts
+
+        offsets = array('I')
+        if header.archive_flags & ARCHIVE_FILE_NAMES:
+            pos = (header.offset + header.folder_count * self._folder_record.size +
+                   header.file_count * FileRecord.size)
+            if header.archive_flags & ARCHIVE_DIRECTORY_NAMES:
+                pos += header.total_folder_name_length + header.folder_count
+            end = pos + header.total_file_name_length
+            for i in range(header.file_count):
+                offsets.append(pos)
+                pos = self._map.find('\0', pos, end) + 1
+        self._name_offsets = offsets
+
+    def file_name(self, folder_index, index):
+        if not self.header.archive_flags & ARCHIVE_FILE_NAMES:
+            return None
+        if self._name_offsets is None:
+            self._build_name_offsets()
+        start = self._name_offsets[self._folder_starts[folder_index] + index]
+        return self._map[start:self._map.find('\0', start)]
+
+    def files(self, folder_index):
+        """The folder's File records, with names."""
+        return [self.file_record(folder_index, i, self.file_name(folder_index, i))
+                for i in range(self.folder_record(folder_index).count)]
+
+    def walk(self):
+        """Yields (folder name, files) for every folder, in hash order."""
+        for i in range(self.header.folder_count):
+            yield self.folder_name(i), self.files(i)
+
+    def find(self, folder_hash, file_hash, name=None):
+        """The File with the given hashes, as from hash_path, or None."""
+        folder_index = self.find_folder(folder_hash)
+        if folder_index is None:
+            return None
+        index = self.find_file(folder_index, file_hash)
+        if index is None:
+            return None
+        return self.file_record(folder_index, index, name)
+
+    def get(self, path):
+        """The File for path, e.g. 'meshes\\critters\\bee\\bee.nif', or None."""
+        folder_hash, file_hash = hash_path(path)
+        return self.find(folder_hash, file_hash, split_path(path)[1])
+
+    def __contains__(self, path):
+        return self.find(*hash_path(path)) is not None
+
+    def open(self, path):
+        """A file object with the uncompressed contents of path."""
+        f = self.get(path)
+        if f is None:
+            raise IOError(errno.ENOENT, 'No such file in archive', path)
+        return StringIO(self.read(f))
+
+    def records(self):
+        """Yields (folder hash, file hash, size, offset) of every file, in
+        hash order. No names are read."""
+        for i in range(self.header.folder_count):
+            folder = self.folder_record(i)
+            offset = self._file_records_offset(folder)
+            for j in range(folder.count):
+                name_hash, size, file_offset = FileRecord.unpack_from(self._map, offset)
+                yield folder.name_hash, name_hash, size, file_offset
+                offset += FileRecord.size
+
+    def is_compressed(self, f):
+        return bool(self.header.archive_flags & ARCHIVE_COMPRESSED) != bool(f.size & FILE_SIZE_COMPRESSED)
+
+    def raw(self, f):
+        """The stored contents of f: (compressed, original size or None, data)."""
+        offset = f.offset
+        size = f.size & FILE_SIZE_MASK
+        if self.version >= 104 and self.header.archive_flags & ARCHIVE_EMBED_NAMES:
+            length = ord(self._map[offset]) + 1 # bstring
+            offset += length
+            size -= length
+        if not self.is_compressed(f):
+            return False, None, self._map[offset:offset+size]
+        original_size = U32.unpack_from(self._map, offset)[0]
+        return True, original_size, self._map[offset+4:offset+size]
+
+    def read(self, f):
+        """The uncompressed contents of f."""
+        compressed, original_size, data = self.raw(f)
+        if not compressed:
+            return data
+        return decompress(data, original_size, self.version)
+
+
+class BSAOverlay(object):
+    """Several archives seen as one, the way the game searches them.
+
+    filenames are in load order: a file in a later archive overrides the
+    same path in an earlier one. The merged index maps (folder hash, file
+    hash) to (archive index, size, offset), so resolving a path is a
+    single dict lookup. It is pickled to cache_file, by default in the
+    user cache directory, and reused while every archive keeps its size
+    and mtime.
+    """
+
+    def __init__(self, filenames, cache_file=None):
+        self.filenames = [os.path.abspath(f) for f in filenames]
+        if cache_file is None:
+            key = hashlib.sha1('\0'.join(self.filenames)).hexdigest()
+            cache_file = os.path.join(default_cache_dir(), 'bsaoverlay-{}.pickle'.format(key))
+        self.cache_file = cache_file
+        self.archives = [BSAArchive(f) for f in self.filenames]
+        stamps = [(f, os.path.getsize(f), os.path.getmtime(f)) for f in self.filenames]
+        self.index = self._load_index(stamps)
+        if self.index is None:
+            self.index = self._build_index()
+            self._save_index(stamps)
+
+    def _load_index(self, stamps):
+        try:
+            with open(self.cache_file, 'rb') as f:
+                cached_stamps, index = pickle.load(f)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        if cached_stamps != stamps:
+            return None
+        return index
+
+    def _save_index(self, stamps):
+        try:
+            directory = os.path.dirname(self.cache_file)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = '%s.%d' % (self.cache_file, os.getpid())
+            with open(tmp, 'wb') as f:
+                pickle.dump((stamps, self.index), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.cache_file)
+        except (IOError, OSError):
+            pass # the cache is only an optimization
+
+    def _build_index(self):
+        index = dict()
+        for archive_index, archive in enumerate(self.archives):
+            for folder_hash, file_hash, size, offset in archive.records():
+                index[folder_hash, file_hash] = (archive_index, size, offset)
+        return index
+
+    def close(self):
+        for archive in self.archives:
+            archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, path):
+        return hash_path(path) in self.index
+
+    def get(self, path):
+        """(archive, File) for path from the archive that wins, or None."""
+        hashes = hash_path(path)
+        try:
+            archive_index, size, offset = self.index[hashes]
+        except KeyError:
+            return None
+        return self.archives[archive_index], File._make([split_path(path)[1], hashes[1], size, offset])
+
+    def read(self, path):
+        found = self.get(path)
+        if found is None:
+            raise IOError(errno.ENOENT, 'No such file in archives', path)
+        archive, f = found
+        return archive.read(f)
+
+    def open(self, path):
+        return StringIO(self.read(path))
+
+def matches(name, patterns):
+    name = name.lower()
+    return any(fnmatchcase(name, p.lower().replace('/', '\\')) for p in patterns)
+
+def select(archive, folders=('*',), names=('*',)):
+    """Yields (folder name, File) for the files matching any of the folder
+    and any of the file name patterns."""
+    if not archive.header.archive_flags & ARCHIVE_DIRECTORY_NAMES:
+        raise ValueError('Archive has no folder names, files can only be found by hash')
+    if not archive.header.archive_flags & ARCHIVE_FILE_NAMES:
+        raise ValueError('Archive has no file names, files can only be found by hash')
+    for i in range(archive.header.folder_count):
+        folder_name = archive.folder_name(i)
+        if not matches(folder_name, folders):
+            continue
+        for f in archive.files(i):
+            if matches(f.name, names):
+                yield folder_name, f
+
+def output_parts(folder_name, name):
+    """The path components of an archived file, refusing names that would
+    end up outside the directory extracted to."""
+    path = (folder_name + '\\' + name if folder_name else name).replace('/', '\\')
+    parts = [part for part in path.split('\\') if part not in ('', '.')]
+    if (path.startswith('\\') or not parts or
+        any(part == '..' or ':' in part for part in parts)):
+        raise ValueError('Unsafe path in archive: {}'.format(path))
+    return parts
+
+def extract(archive, write_to, folders=('*',), names=('*',), workers=None):
+    """Extracts the matching files of archive below directory write_to.
+
+    The stored data is read here and handed through a bounded queue to a
+    pool of threads that decompress and write it; zlib releases the GIL,
+    so decompression runs on every core. Returns the number of files.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    queue = Queue(maxsize=workers * 4)
+    errors = list()
+
+    def work():
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            if errors:
+                continue
+            path, (compressed, original_size, data) = item
+            try:
+                if compressed:
+                    data = decompress(data, original_size, archive.version)
+                with open(path, 'wb') as outfile:
+                    outfile.write(data)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=work) for c in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    count = 0
+    directories = set()
+    try:
+        for folder_name, f in select(archive, folders, names):
+            parts = output_parts(folder_name, f.name)
+            directory = os.path.join(write_to, *parts[:-1])
+            if directory not in directories:
+                try:
+                    os.makedirs(directory)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                directories.add(directory)
+            queue.put((os.path.join(directory, parts[-1]), archive.raw(f)))
+            count += 1
+            if errors:
+                break
+    finally:
+        for t in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+    return count
+
+def compress(data, version, level=6):
+    if version >= 105:
+        if lz4 is None:
+            raise ValueError('Version 105 archives need the lz4 module')
+        return lz4.frame.compress(data, compression_level=level)
+    return zlib.compress(data, level)
+
+def collect(directory):
+    """{folder name: {file name: path}} for the files below directory,
+    named the way they are hashed."""
+    tree = defaultdict(dict)
+    for dirpath, dirnames, filenames in os.walk(directory):
+        if not filenames:
+            continue
+        folder_name = os.path.relpath(dirpath, directory)
+        if folder_name == os.curdir:
+            raise ValueError('Files must be in a folder: {}'.format(filenames))
+        folder_name = folder_name.replace(os.sep, '\\').lower()
+        for filename in filenames:
+            tree[folder_name][filename.lower()] = os.path.join(dirpath, filename)
+    return tree
+
+def _stored_data(path, name, version, compressed, level):
+    # name is the embedded name, or None
+    with open(path, 'rb') as infile:
+        data = infile.read()
+    size_flag = 0
+    if compressed:
+        packed = compress(data, version, level)
+        if len(packed) + 4 < len(data):
+            data = U32.pack(len(data)) + packed
+        else:
+            size_flag = FILE_SIZE_COMPRESSED # store it as is
+    if name is not None:
+        data = chr(len(name)) + name + data
+    return data, size_flag
+
+def write_archive(directory, filename, version=104, compressed=True, embed_names=False,
+                  workers=None, level=6):
+    """Writes the files below directory to the archive filename.
+
+    Folder and file records are sorted by hash. File contents are
+    compressed in a thread pool and written in record order as they
+    complete, with at most a few files per thread held in memory; the
+    records are written last, once the data offsets and sizes are known.
+    Files that do not shrink are stored uncompressed.
+    """
+    if version not in FolderRecord:
+        raise ValueError('Unsupported BSA version {}'.format(version))
+    if embed_names and version < 104:
+        raise ValueError('Embedded names need version 104 or later')
+    tree = collect(directory)
+
+    folders = list() # (hash, name, [(hash, name, path)])
+    for folder_name, files in tree.items():
+        file_list = sorted((tesHash(name, True), name, path) for name, path in files.items())
+        for a, b in zip(file_list, file_list[1:]):
+            if a[0] == b[0]:
+                raise ValueError('Hash collision in {}: {} and {}'.format(folder_name, a[1], b[1]))
+        folders.append((tesHash(folder_name), folder_name, file_list))
+    folders.sort()
+    for a, b in zip(folders, folders[1:]):
+        if a[0] == b[0]:
+            raise ValueError('Hash collision: {} and {}'.format(a[1], b[1]))
+    for folder_hash, folder_name, files in folders:
+        for name in [folder_name] + [f[1] for f in files]:
+            if len(name) > 254:
+                raise ValueError('Name too long: {}'.format(name))
+        if embed_names:
+            # The embedded name is a bstring of the full path.
+            for file_hash, name, path in files:
+                if len(folder_name) + 1 + len(name) > 255:
+                    raise ValueError('Path too long to embed: {}\\{}'.format(folder_name, name))
+
+    archive_flags = ARCHIVE_DIRECTORY_NAMES | ARCHIVE_FILE_NAMES
+    if compressed:
+        archive_flags |= ARCHIVE_COMPRESSED
+    if embed_names:
+        archive_flags |= ARCHIVE_EMBED_NAMES
+    file_flags = 0
+    for folder_hash, folder_name, files in folders:
+        for file_hash, name, path in files:
+            file_flags |= FileFlags.get(os.path.splitext(name)[1], FILE_FLAGS_MISC)
+    file_names = ''.join(name + '\0' for folder in folders for file_hash, name, path in folder[2])
+    header = BSAHeader._make(['BSA\0', version, HeaderStruct.size, archive_flags,
+                              len(folders), sum(len(folder[2]) for folder in folders),
+                              sum(len(folder[1]) + 1 for folder in folders),
+                              len(file_names), file_flags])
+    folder_record = FolderRecord[version]
+    blocks_offset = header.offset + header.folder_count * folder_record.size
+    data_offset = (blocks_offset + header.total_folder_name_length + header.folder_count +
+                   header.file_count * FileRecord.size + header.total_file_name_length)
+
+    workers = workers or multiprocessing.cpu_count()
+    pool = ThreadPool(workers)
+    sizes = list()
+    offsets = list()
+    try:
+        with open(filename, 'wb') as bsafile:
+            bsafile.seek(data_offset)
+            pending = deque()
+
+            def write_next():
+                data, size_flag = pending.popleft().get()
+                offset = bsafile.tell()
+                if offset + len(data) > 0xFFFFFFFF or len(data) > FILE_SIZE_MASK:
+                    raise ValueError('Archive too large')
+                offsets.append(offset)
+                sizes.append(len(data) | size_flag)
+                bsafile.write(data)
+
+            for folder_hash, folder_name, files in folders:
+                for file_hash, name, path in files:
+                    embedded = folder_name + '\\' + name if embed_names else None
+                    pending.append(pool.apply_async(_stored_data,
+                                                    (path, embedded, version, compressed, level)))
+                    if len(pending) >= workers * 2:
+                        write_next()
+            while pending:
+                write_next()
+
+            records = [HeaderStruct.pack(*header)]
+            blocks = list()
+            block_offset = blocks_offset
+            index = 0
+            for folder_hash, folder_name, files in folders:
+                folder_offset = block_offset + header.total_file_name_length
+                if version >= 105:
+                    records.append(folder_record.pack(folder_hash, len(files), 0, folder_offset))
+                else:
+                    records.append(folder_record.pack(folder_hash, len(files), folder_offset))
+                block = [chr(len(folder_name) + 1), folder_name, '\0']
+                for file_hash, name, path in files:
+                    block.append(FileRecord.pack(file_hash, sizes[index], offsets[index]))
+                    index += 1
+                block = ''.join(block)
+                blocks.append(block)
+                block_offset += len(block)
+            bsafile.seek(0)
+            bsafile.write(''.join(records + blocks))
+            bsafile.write(file_names)
+    except BaseException:
+        # Don't leave a partial archive behind.
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
+    finally:
+        pool.terminate()
+    return header
+
+def decompress(data, original_size, version):
+    if version >= 105:
+        if lz4 is None:
+            raise ValueError('Version 105 archives need the lz4 module')
+        return lz4.frame.decompress(data)
+    return zlib.decompress(data)
+
+def split_path(path):
+    """Folder and file name of path, normalized the way the hashes are."""
+    path = path.lower().replace('/', '\\')
+    folder_name, _, file_name = path.rpartition('\\')
+    return folder_name, file_name
+
+PATH_HASH_CACHE_SIZE = 4096
+_path_hashes = OrderedDict() # least recently used first
+
+def hash_path(path):
+    """(folder hash, file hash) of path. Recently used paths are cached."""
+    try:
+        hashes = _path_hashes.pop(path)
+    except KeyError:
+        folder_name, file_name = split_path(path)
+        hashes = (tesHash(folder_name), tesHash(file_name, True))
+        if len(_path_hashes) >= PATH_HASH_CACHE_SIZE:
+            _path_hashes.popitem(last=False)
+    _path_hashes[path] = hashes
+    return hashes
+
+def hash_paths(paths):
+    """(folder hash, file hash) of each path, computed in bulk.
+
+    With numpy the rolling part of tesHash is computed for all names at
+    once, one character position at a time. The cache is not used.
+    """
+    folder_names, file_names = zip(*map(split_path, paths)) or ((), ())
+    return zip(tesHashes(folder_names), tesHashes(file_names, True))
+
+def _rolling_hashes(strings):
+    if numpy is None or len(strings) < 64:
+        return [_rolling_hash(s) for s in strings]
+    lengths = numpy.array(map(len, strings))
+    width = int(max(lengths.max(), 1))
+    chars = numpy.frombuffer(''.join(s.ljust(width, '\0') for s in strings),
+                             dtype=numpy.uint8).reshape(len(strings), width)
+    hashes = numpy.zeros(len(strings), dtype=numpy.uint64)
+    for column in range(width):
+        updated = (hashes * 0x1003f + chars[:, column]) & 0xFFFFFFFF
+        hashes = numpy.where(lengths > column, updated, hashes)
+    return hashes.tolist()
+
+def _rolling_hash(s):
+    h = 0
+    for char in bytearray(s):
+        h = ((h * 0x1003f) + char) & 0xFFFFFFFF
+    return h
+
+def _hash1(root, ext):
+    chars = bytearray(root)
+    if len(chars) > 2:
+        bchar = chars[-2]
+    else:
+        bchar = 0
+    hash1 = chars[-1] | bchar << 8 | len(chars) << 16 | chars[0] << 24
+    return hash1 | ExtensionBits.get(ext, 0)
+
+ExtensionBits = {'.kf': 0x80, '.nif': 0x8000, '.dds': 0x8080, '.wav': 0x80000000}
+
+def tesHashes(fileNames, use_ext=False):
+    """tesHash of every name in fileNames."""
+    if use_ext:
+        roots, exts = zip(*[os.path.splitext(name.lower()) for name in fileNames]) or ((), ())
+    else:
+        roots, exts = fileNames, [''] * len(fileNames)
+    hash2 = _rolling_hashes([root[1:-2] for root in roots])
+    hash3 = _rolling_hashes(exts)
+    return [(((h2 + h3) & 0xFFFFFFFF) << 32) + _hash1(root, ext)
+            for root, ext, h2, h3 in zip(roots, exts, hash2, hash3)]
+
 def parse_b_or_bzstring(filehandle, bz=False):
     # A string prefixed with a byte length and optionally terminated with a zero (\x00).
     length = unpack('B', filehandle.read(1))[0]
@@ -94,41 +737,22 @@ def tesHash(fileName, use_ext=False):
         root = fileName
         ext = ''
 
-    #--Hash1
-    chars = map(ord, root) #--'bob' >> chars = [98,11,98]
-    if len(chars) > 2:
-        bchar = chars[-2]
-    else:
-        bchar = 0
-    hash1 = chars[-1] | bchar << 8 | len(chars) << 16 | chars[0] << 24
-
-    if   ext == '.kf':  hash1 |= 0x80
-    elif ext == '.nif': hash1 |= 0x8000
-    elif ext == '.dds': hash1 |= 0x8080
-    elif ext == '.wav': hash1 |= 0x80000000
-    #--Hash2
-    #--Python integers have no upper limit. Use uintMask to restrict these to 32 bits.
-    uintMask, hash2, hash3 = 0xFFFFFFFF, 0, 0
-    for char in chars[1:-2]: #--Slice of the chars array
-        hash2 = ((hash2 * 0x1003f) + char ) & uintMask
-    for char in map(ord,ext):
-        hash3 = ((hash3 * 0x1003F) + char ) & uintMask
-    hash2 = (hash2 + hash3) & uintMask
-    #--Done
+    hash1 = _hash1(root, ext)
+    hash2 = (_rolling_hash(root[1:-2]) + _rolling_hash(ext)) & 0xFFFFFFFF
     return (hash2 << 32) + hash1 #--Return as uint64
 
 
 if __name__ == '__main__':
     options = get_options()
-    header, folders, file_names, files = load(options.bsafile)
-    for k, d in folders.iteritems():
-        if d.name == 'meshes\\critters\\bee':
-            with open(options.bsafile, 'rb') as bsafile:
-                for f in d.files:
-                    bsafile.seek(f.offset)
-                    with open(f.name, 'wb') as outfile:
-                        contents = bsafile.read(f.size)
-                        outfile.write(zlib.decompress(contents))
-
-
-    print 'Done.'
+    if options.create:
+        header = write_archive(options.create, options.bsafile, options.archive_version,
+                               options.compress, options.embed_names, options.jobs)
+        print 'Wrote {} files in {} folders.'.format(header.file_count, header.folder_count)
+        sys.exit(0)
+    with BSAArchive(options.bsafile) as archive:
+        if options.list:
+            for folder_name, f in select(archive, options.folders, options.names):
+                print '{}\\{} {}'.format(folder_name, f.name, f.size & FILE_SIZE_MASK)
+        else:
+            count = extract(archive, options.write_to, options.folders, options.names, options.jobs)
+            print 'Extracted {} files.'.format(count)
@@ -1,14 +1,22 @@
 #!/usr/bin/env python
 
 import argparse
+from array import array
 import datetime
 from collections import namedtuple
-from struct import unpack, pack, error
+import mmap
+import os
+from struct import unpack, unpack_from, pack, pack_into, error, Struct
 
 import sys
 import ImageFile
 import Image
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def get_options():
     parser = argparse.ArgumentParser(description='ff')
     parser.add_argument('-f', '--essfile', dest='essfile', type=str)
@@ -17,18 +25,37 @@ def get_options():
     parser.add_argument('-p', '--list_plugins', dest='list_plugins', action='store_true')
     parser.add_argument('-r', '--list_records', dest='list_records', action='store_true')
     parser.add_argument('-w', '--write_to', dest='write_to', type=str)
+    parser.add_argument('-e', '--set', dest='set', action='append', metavar='FIELD=VALUE',
+                        help='patch a fixed-size field in place, e.g. pcLevel=20, globals:0x15=1.5, pcLocation=3060,1.0,2.0,3.0')
     return parser.parse_args()
 
 def enum(**nums):
     res = namedtuple('Enum', nums.keys())
     return res(*nums.values()), dict((v,k) for k, v in nums.iteritems())
 
-SaveGame = namedtuple('SaveGame', 'fileheader gameheader globals plugins records tempEffectsData formIds worldSpaces')
+SaveGame = namedtuple('SaveGame', 'fileheader gameheader globals plugins records tempEffectsData formIds worldSpaces offsets')
 FileHeader = namedtuple('FileHeader', 'fileId majorVersion minorVersion exeTime')
 SaveGameHeader = namedtuple('SaveGameHeader', 'headerVersion saveHeaderSize saveNum pcName pcLevel pcLocation gameDays gameTicks gameTime screenshot')
 Globals = namedtuple('Globals', 'formIdsOffset recordsNum nextObjectId worldId worldX worldY pcLocation globalsNum globals tesClassSize numDeathCounts deathCounts gameModeSeconds processesSize processesData specEventSize specEventData weatherSize weatherData playerCombatCount createdNum createdData quickKeysSize quickKeysData reticuleSize reticuleData interfaceSize interfaceData regionsSize regionsNum regions')
 PCLocation = namedtuple('PCLocation', 'cell x y z')
 
+# Fields that can be patched in place, with their formats. Keys of the
+# dict-valued globals, deathCounts and regions are (field, iref) tuples.
+FieldFormats = {'saveNum': 'I',
+                'pcLevel': 'H',
+                'gameDays': 'f',
+                'gameTicks': 'I',
+                'nextObjectId': 'I',
+                'worldId': 'I',
+                'worldX': 'I',
+                'worldY': 'I',
+                'pcLocation': 'I3f',
+                'gameModeSeconds': 'f',
+                'playerCombatCount': 'I',
+                'globals': 'f',
+                'deathCounts': 'H',
+                'regions': 'I'}
+
 RecordTypes, RecordTypeNames = enum(FACT=6,
                                     APPA=19,
                                     ARMO=20,
@@ -104,21 +131,27 @@ def parse_screenshot(filehandle, write_to_file=None):
         im.save(write_to_file)
     return im
 
-def parse_globals(filehandle):
+def parse_globals(filehandle, offsets=None):
     n_globals = unpack('H', filehandle.read(2))[0]
     globals_dict = dict()
     for n in range(n_globals):
+        position = filehandle.tell()
         iref, value = unpack('If', filehandle.read(8))
         globals_dict[iref] = value
+        if offsets is not None:
+            offsets['globals', iref] = position + 4
 
     return [n_globals, globals_dict]
 
-def parse_deathcounts(filehandle):
+def parse_deathcounts(filehandle, offsets=None):
     numDeathCounts = unpack('I', filehandle.read(4))[0]
     deathCounts = dict()
     for n in range(numDeathCounts):
+        position = filehandle.tell()
         actor, deathCount = unpack('IH', filehandle.read(6))
         deathCounts[actor] = deathCount
+        if offsets is not None:
+            offsets['deathCounts', actor] = position + 4
 
     return [numDeathCounts, deathCounts]
 
@@ -179,34 +212,127 @@ def parse_quickkeydata(filehandle):
 
     # return [quickKeysSize, quickKeys]
 
-def parse_regions(filehandle):
+def parse_regions(filehandle, offsets=None):
     size, count = unpack('2H', filehandle.read(4))
 
     regions = dict()
     for n in range(count):
+        position = filehandle.tell()
         iref, value = unpack('II', filehandle.read(8))
         regions[iref] = value
+        if offsets is not None:
+            offsets['regions', iref] = position + 4
 
     return [size, count, regions]
 
 
-def parse_record(filehandle):
-#    formId, record_type, flags, version, datasize = unpack('=IBIBH', filehandle.read(12))
-    formId, = unpack('I', filehandle.read(4))
-    record_type, = unpack('B', filehandle.read(1))
-    flags, = unpack('I', filehandle.read(4))
-    version, = unpack('B', filehandle.read(1))
-    datasize, = unpack('H', filehandle.read(2))
-
-    data = filehandle.read(datasize)
-    if record_type =='MISC':
-        parse_misc(data)
-    return [formId, record_type, flags, version, datasize, data]
-
-def parse_misc(data):
-    print data
+RecordHeader = Struct('<IBIBH') # formId, type, flags, version, datasize
+
+class RecordTable(object):
+    """The change records of a save, as parallel array columns.
+
+    The headers are scanned in one pass with a single unpack each; the
+    record data stays in buf (an mmap) and is sliced out when a record is
+    accessed. Records read as [formId, type, flags, version, datasize,
+    data] lists.
+    """
+
+    def __init__(self, buf, offset, count):
+        self._buffer = buf
+        self.begin = offset
+        self.formIds = array('I')
+        self.types = array('B')
+        self.flags = array('I')
+        self.versions = array('B')
+        self.sizes = array('H')
+        self.offsets = array('I')
+        self._replaced = dict()
+        self._appended = 0
+
+        unpack_header = RecordHeader.unpack_from
+        header_size = RecordHeader.size
+        for c in range(count):
+            formId, record_type, flags, version, datasize = unpack_header(buf, offset)
+            offset += header_size
+            self.formIds.append(formId)
+            self.types.append(record_type)
+            self.flags.append(flags)
+            self.versions.append(version)
+            self.sizes.append(datasize)
+            self.offsets.append(offset)
+            offset += datasize
+        self.end = offset
+
+    def __len__(self):
+        return len(self.formIds) + self._appended
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index in self._replaced:
+            return self._replaced[index]
+        if self._buffer is None:
+            raise ValueError('Record table is closed')
+        offset = self.offsets[index]
+        size = self.sizes[index]
+        return [self.formIds[index], self.types[index], self.flags[index],
+                self.versions[index], size, self._buffer[offset:offset+size]]
+
+    def __setitem__(self, index, record):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        self._replaced[index] = list(record)
+
+    def append(self, record):
+        self._replaced[len(self)] = list(record)
+        self._appended += 1
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def positions_of_type(self, *types):
+        """Positions of the records of the given types, as an array."""
+        if numpy is not None:
+            column = numpy.frombuffer(self.types, dtype=numpy.uint8)
+            positions = numpy.flatnonzero(numpy.isin(column, types)).tolist()
+        else:
+            wanted = set(types)
+            positions = [i for i, t in enumerate(self.types) if t in wanted]
+        if self._replaced:
+            positions = sorted(set(i for i in positions if i not in self._replaced).union(
+                i for i, record in self._replaced.items() if record[1] in types))
+        return array('I', positions)
+
+    def of_type(self, *types):
+        for index in self.positions_of_type(*types):
+            yield self[index]
+
+    def known_positions(self):
+        """Positions of the records whose type is in RecordTypes."""
+        return self.positions_of_type(*RecordTypes)
+
+    def close(self):
+        """Unmap the save. Records read before stay valid; the table can't
+        be read from afterwards."""
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 def load(filename, imagename=None):
+    """Parse an Oblivion save. savegame.offsets holds the file offset of
+    every field in FieldFormats, for patch_fields."""
+    offsets = dict()
     with open(filename, 'rb') as essfile:
         # FileHeader
         headerpart = list(unpack('12s B B', essfile.read(14)))
@@ -214,12 +340,16 @@ def load(filename, imagename=None):
         h = FileHeader._make(headerpart)
 
         # SaveGameHeader
+        offsets['saveNum'] = essfile.tell() + 8
         gameheader = list(unpack('3I', essfile.read(12)))
 
         gameheader.append(parse_b_or_bzstring(essfile, bz=True))
+        offsets['pcLevel'] = essfile.tell()
         gameheader.append(unpack('H', essfile.read(2))[0])
 
         gameheader.append(parse_b_or_bzstring(essfile, bz=True))
+        offsets['gameDays'] = essfile.tell()
+        offsets['gameTicks'] = essfile.tell() + 4
         gameheader.extend(list(unpack('fI', essfile.read(8))))
         gameheader.append(parse_systemtime(essfile))
         gameheader.append(parse_screenshot(essfile, imagename))
@@ -233,13 +363,18 @@ def load(filename, imagename=None):
 
         # Globals
         globalslist = list()
+        position = essfile.tell()
+        for index, field in enumerate(Globals._fields[2:6]):
+            offsets[field] = position + 8 + 4 * index
         globalslist.extend(list(unpack('6I', essfile.read(24))))
+        offsets['pcLocation'] = essfile.tell()
         pcloc = PCLocation._make(unpack('I3f', essfile.read(16)))
         globalslist.append(pcloc)
-        globalslist.extend(parse_globals(essfile))
+        globalslist.extend(parse_globals(essfile, offsets))
         tesClassSize = unpack('H', essfile.read(2))[0]
         globalslist.append(tesClassSize)
-        globalslist.extend(parse_deathcounts(essfile))
+        globalslist.extend(parse_deathcounts(essfile, offsets))
+        offsets['gameModeSeconds'] = essfile.tell()
         globalslist.append(unpack('f', essfile.read(4))[0])
 
         # processesData
@@ -250,6 +385,7 @@ def load(filename, imagename=None):
 
         # weatherData
         globalslist.extend(parse_bytelist(essfile))
+        offsets['playerCombatCount'] = essfile.tell()
         globalslist.append(unpack('I', essfile.read(4))[0])
         globalslist.extend(parse_createddata(essfile))
         globalslist.extend(parse_quickkeydata(essfile))
@@ -261,16 +397,14 @@ def load(filename, imagename=None):
         globalslist.extend(parse_bytelist(essfile))
 
         # regions
-        globalslist.extend(parse_regions(essfile))
+        globalslist.extend(parse_regions(essfile, offsets))
 
         g = Globals._make(globalslist)
 
         # change records
-        records = list()
-        for c in range(g.recordsNum):
-            record = parse_record(essfile)
-            records.append(record)
-            formId, record_type, flags, version, datasize, data = records[-1]
+        buf = mmap.mmap(essfile.fileno(), 0, access=mmap.ACCESS_READ)
+        records = RecordTable(buf, essfile.tell(), g.recordsNum)
+        essfile.seek(records.end)
 
         # temporary effects
         tempEffectsSize = unpack('I', essfile.read(4))[0]
@@ -284,11 +418,124 @@ def load(filename, imagename=None):
         worldSpacesNum = unpack('I', essfile.read(4))[0]
         worldSpaces = unpack('%sI' % worldSpacesNum, essfile.read(4 * worldSpacesNum))
 
-    savegame = SaveGame._make([h, s, g, plugins, records, tempEffectsData, formIds, worldSpaces])
+    savegame = SaveGame._make([h, s, g, plugins, records, tempEffectsData, formIds, worldSpaces, offsets])
     return savegame
 
+def field_format(key):
+    if isinstance(key, tuple):
+        key = key[0]
+    return '<' + FieldFormats[key]
+
+def patch_fields(filename, changes, savegame=None):
+    """Overwrite fixed-size fields of the save in place.
+
+    changes maps FieldFormats keys, or (field, iref) for globals,
+    deathCounts and regions, to new values; only those bytes are written,
+    through an mmap of the file. savegame is the loaded file, if at hand.
+    """
+    with open(filename, 'r+b') as essfile:
+        buf = mmap.mmap(essfile.fileno(), 0)
+        try:
+            if savegame is None:
+                offsets = field_offsets(buf)
+            else:
+                offsets = savegame.offsets
+            for key, value in changes.items():
+                if not isinstance(value, (tuple, list)):
+                    value = [value]
+                pack_into(field_format(key), buf, offsets[key], *value)
+            buf.flush()
+        finally:
+            buf.close()
+
+def field_offsets(buf):
+    """The offsets load() puts in savegame.offsets, found by stepping over
+    the sections of buf by their sizes. Nothing is decoded, so only the
+    pages holding the headers of the globals section are read."""
+    offsets = dict()
+    pos = 14 + 16 # FileHeader
+    offsets['saveNum'] = pos + 8
+    pos += 12
+    pos += 1 + ord(buf[pos]) # pcName
+    offsets['pcLevel'] = pos
+    pos += 2
+    pos += 1 + ord(buf[pos]) # pcLocation
+    offsets['gameDays'] = pos
+    offsets['gameTicks'] = pos + 4
+    pos += 8 + 16 # gameDays, gameTicks, gameTime
+    pos += 4 + unpack_from('I', buf, pos)[0] # screenshot
+    plugincount = ord(buf[pos])
+    pos += 1
+    for index in range(plugincount):
+        pos += 1 + ord(buf[pos])
+
+    for index, field in enumerate(Globals._fields[2:6]):
+        offsets[field] = pos + 8 + 4 * index
+    pos += 24
+    offsets['pcLocation'] = pos
+    pos += 16
+    n_globals, = unpack_from('H', buf, pos)
+    pos += 2
+    for n in range(n_globals):
+        offsets['globals', unpack_from('I', buf, pos)[0]] = pos + 4
+        pos += 8
+    pos += 2 # tesClassSize
+    numDeathCounts, = unpack_from('I', buf, pos)
+    pos += 4
+    for n in range(numDeathCounts):
+        offsets['deathCounts', unpack_from('I', buf, pos)[0]] = pos + 4
+        pos += 6
+    offsets['gameModeSeconds'] = pos
+    pos += 4
+    for n in range(3): # processesData, specEventData, weatherData
+        pos += 2 + unpack_from('H', buf, pos)[0]
+    offsets['playerCombatCount'] = pos
+    pos += 4
+    createdNum, = unpack_from('I', buf, pos)
+    pos += 4
+    for n in range(createdNum):
+        pos += 20 + unpack_from('I', buf, pos + 4)[0]
+    for n in range(3): # quickKeysData, reticuleData, interfaceData
+        pos += 2 + unpack_from('H', buf, pos)[0]
+    size, count = unpack_from('2H', buf, pos)
+    pos += 4
+    for n in range(count):
+        offsets['regions', unpack_from('I', buf, pos)[0]] = pos + 4
+        pos += 8
+    return offsets
+
+def parse_field_change(change):
+    """'FIELD=VALUE' from the command line as a patch_fields key and value."""
+    if '=' not in change:
+        raise ValueError('Expected FIELD=VALUE, got %r' % change)
+    key, value = change.split('=', 1)
+    name = key
+    if ':' in key:
+        key, iref = key.split(':', 1)
+        key = (key, int(iref, 0))
+    if (key[0] if isinstance(key, tuple) else key) not in FieldFormats:
+        raise ValueError('Unknown field %s, expected one of %s' %
+                         (name, ', '.join(sorted(FieldFormats))))
+    codes = field_format(key)[1:].replace('3f', 'fff')
+    strings = value.split(',')
+    if len(strings) != len(codes):
+        raise ValueError('%s takes %d value(s), got %d' % (name, len(codes), len(strings)))
+    try:
+        values = [float(v) if c == 'f' else int(v, 0) for c, v in zip(codes, strings)]
+        pack(field_format(key), *values)
+    except (ValueError, error):
+        raise ValueError('Bad value for %s: %s' % (name, value))
+    return key, values
+
 def write(savegame, filename):
-    with open(filename, 'wb') as essfile:
+    """Write savegame to filename.
+
+    The record bodies are read from an mmap of the loaded file, which may
+    be filename itself, so the save is written under a temporary name and
+    renamed over filename when complete.
+    """
+    tmp = '%s.%d' % (filename, os.getpid())
+    with open(tmp, 'wb') as essfile:
         # Fileheader
         essfile.write(savegame.fileheader.fileId)
         essfile.write(pack('BB', savegame.fileheader.majorVersion,
@@ -380,10 +627,20 @@ def write(savegame, filename):
         essfile.write(pack('%sI' % len(savegame.formIds), *(savegame.formIds)))
         essfile.write(pack('I', len(savegame.worldSpaces)))
         essfile.write(pack('%sI' % len(savegame.worldSpaces), *(savegame.worldSpaces)))
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename) # rename doesn't replace an existing file there
+    os.rename(tmp, filename)
 
 if __name__ == '__main__':
     options = get_options()
     savegame = load(options.essfile, options.image)
+    if options.set:
+        try:
+            changes = dict(map(parse_field_change, options.set))
+        except ValueError as e:
+            sys.exit('essedit.py: error: %s' % e)
+        patch_fields(options.essfile, changes, savegame)
+        sys.exit(0)
     if options.essfile2:
         savegame2 = load(options.essfile2, False)
         for x, y, field in zip(savegame.globals, savegame2.globals, Globals._fields):
@@ -416,6 +673,7 @@ if __name__ == '__main__':
 
     if options.write_to:
         write(savegame, options.write_to)
+    savegame.records.close()
 
     #print savegame.globals.pcLocation
     #print 'Done.'
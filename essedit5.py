@@ -1,27 +1,42 @@
 #!/usr/bin/env python
 
 import argparse
-from difflib import SequenceMatcher, context_diff
+import asyncio
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import csv
+from array import array
+from bisect import bisect_left
+from difflib import context_diff
 import datetime
+import hashlib
 from collections import defaultdict, namedtuple, OrderedDict
 import logging
-from struct import unpack, pack, error
+from struct import unpack, pack, error, Struct
 import time
+import mmap
 import os
+import pickle
 import pprint
 import io
 import sys
+import zlib
 from PIL import ImageFile
 from PIL import Image
 
-from stringtables import StringStore
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from stringtables import StringStore, default_cache_dir
 
 log = logging
 
 
 def get_options():
     parser = argparse.ArgumentParser(description='ff')
-    parser.add_argument('-f', '--essfile', required=True, dest='essfile', type=str)
+    parser.add_argument('-f', '--essfile', dest='essfile', type=str)
     parser.add_argument('-g', '--essfile2', dest='essfile2', type=str)
     parser.add_argument('-s', '--stringsfile', dest='stringsfile', type=str, nargs='*')
     parser.add_argument('-i', '--image', dest='image', type=str)
@@ -29,8 +44,21 @@ def get_options():
     parser.add_argument('-r', '--list_records', dest='list_records', type=str)
     parser.add_argument('-w', '--write_to', dest='write_to', type=str)
     parser.add_argument('--header-only', dest='header_only', action='store_true')
+    parser.add_argument('--lazy', dest='lazy', action='store_true')
+    parser.add_argument('--form-strings', dest='form_strings', type=str,
+                        help='file of formid and name string id pairs, for -s/--stringsfile')
+    parser.add_argument('--orphans', dest='orphans', action='store_true',
+                        help='list orphaned Papyrus script instances')
+    parser.add_argument('--validate', dest='validate', type=str, metavar='DIR',
+                        help='check that every save in DIR is written back byte for byte')
+    parser.add_argument('--library', dest='library', type=str)
+    parser.add_argument('--export', dest='export', type=str)
+    parser.add_argument('--export-format', dest='export_format', choices=['npz', 'csv'], default='npz')
     parser.add_argument('-v', '--verbose', dest='verbose', action='count')
-    return parser.parse_args()
+    options = parser.parse_args()
+    if not (options.essfile or options.library or options.stringsfile or options.validate):
+        parser.error('one of -f/--essfile, --library, --validate or -s/--stringsfile is required')
+    return options
 
 def enum(**nums):
     res = namedtuple('Enum', list(nums.keys()))
@@ -39,9 +67,11 @@ def enum(**nums):
 SaveGame = namedtuple('SaveGame', 'gameheader filelocations plugins g1 g2 changeforms g3 formIDArray visitedWorldspaceArrayCount visitedWorldspaceArray unknownBytes')
 SaveGameHeader = namedtuple('SaveGameHeader', 'magic headerSize version saveNumber playerName playerLevel playerLocation gameDate playerRaceEditorId playerSex playerCurExp playerLvlUpExp filetime screenshot formVersion pluginInfoSize plugincount')
 FileLocationTable = namedtuple('FileLocationTable', 'formIDArrayOffset unknownTable3Offset globalDataTable1Offset globalDataTable2Offset changeFormsOffset globalDataTable3Offset globalDataTable1Count globalDataTable2Count globalDataTable3Count changeFormCount unused1 unused2 unused3 unused4 unused5 unused6 unused7 unused8 unused9 unused10 unused11 unused12 unused13 unused14 unused15')
+FileLocationTable_size = 25*4
 Globals1 = namedtuple('Globals1', 'misc_stats player_location tes global_variables created_objects effects weater audio skycells')
 PCLocation = namedtuple('PCLocation', 'cell x y z')
 Record = namedtuple('Record', 'formid changeflags type version length1 length2 data')
+MiscStat = namedtuple('MiscStat', 'name category value')
 
 FormTypes = {
     0: ('NONE', '', ''),
@@ -241,6 +271,8 @@ savegameform_to_form = {
 
 form_to_savegameform = {v:k for k,v in list(savegameform_to_form.items())}
 
+FormTypeIds = {v[0]:k for k,v in list(FormTypes.items()) if v[0]}
+
 StatCategoryNames = {0:'General',
                      1:'Quest',
                      2:'Combat',
@@ -248,25 +280,206 @@ StatCategoryNames = {0:'General',
                      4:'Crafting',
                      5:'Crime'}
 
+StatCategoryIds = {v:k for k,v in list(StatCategoryNames.items())}
+
+_structs = dict()
+
+def get_struct(fmt):
+    """A cached little-endian struct.Struct for fmt."""
+    try:
+        return _structs[fmt]
+    except KeyError:
+        s = _structs[fmt] = Struct('<' + fmt)
+        return s
+
+U8 = get_struct('B')
+U16 = get_struct('H')
+U32 = get_struct('I')
+I32 = get_struct('i')
+F32 = get_struct('f')
+
+
+class Reader(object):
+    """Cursor over a bytes-like buffer (bytes, bytearray, mmap, memoryview).
+
+    Fields are decoded with cached Struct objects and unpack_from at an
+    integer offset, so no intermediate bytes are created per field. The
+    read/tell/seek methods let parsers that still expect a file object
+    run on a Reader unchanged.
+    """
+
+    def __init__(self, buf, offset=0):
+        self.buf = buf
+        self.offset = offset
+
+    def read(self, size=-1):
+        begin = self.offset
+        if size < 0:
+            self.offset = len(self.buf)
+        else:
+            self.offset = min(begin + size, len(self.buf))
+        return bytes(self.buf[begin:self.offset])
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.offset
+        elif whence == os.SEEK_END:
+            offset += len(self.buf)
+        self.offset = offset
+        return offset
+
+    def skip(self, size):
+        self.offset += size
+
+    def view(self, size):
+        """The next size bytes as a memoryview into the buffer."""
+        begin = self.offset
+        self.offset += size
+        if self.offset > len(self.buf):
+            raise error('unpack requires a buffer of %d bytes' % size)
+        return memoryview(self.buf)[begin:self.offset]
+
+    def unpack(self, fmt):
+        s = get_struct(fmt)
+        values = s.unpack_from(self.buf, self.offset)
+        self.offset += s.size
+        return values
+
+    def _one(self, s):
+        value, = s.unpack_from(self.buf, self.offset)
+        self.offset += s.size
+        return value
+
+    def u8(self):
+        return self._one(U8)
+
+    def u16(self):
+        return self._one(U16)
+
+    def u32(self):
+        return self._one(U32)
+
+    def i32(self):
+        return self._one(I32)
+
+    def f32(self):
+        return self._one(F32)
+
+    def vsval(self):
+        # The low two bits of the first byte give the width: 1, 2 or 4 bytes.
+        buf, offset = self.buf, self.offset
+        byte0 = buf[offset]
+        flag = byte0 & 3
+        if flag == 0:
+            self.offset += 1
+            return byte0 >> 2
+        elif flag == 1:
+            self.offset += 2
+            return (byte0 | (buf[offset+1] << 8)) >> 2
+        elif flag == 2:
+            value, = U32.unpack_from(buf, offset)
+            self.offset += 4
+            return value >> 2
+        raise ValueError("Invalid vsval at offset %d" % offset)
+
+    def wstring(self, z=False):
+        # A string prefixed with a uint16 length and optionally terminated with a zero (\x00).
+        length = self.u16()
+        s = bytes(self.buf[self.offset:self.offset+length])
+        self.offset += length
+        if z:
+            return s[:-1]
+        return s
+
+    def refid(self):
+        buf, offset = self.buf, self.offset
+        byte0 = buf[offset]
+        self.offset += 3
+        return byte0 >> 6, ((byte0 & 63) << 16) + (buf[offset+1] << 8) + buf[offset+2]
+
+    def refids(self, count):
+        result = decode_refids(self.buf, count, self.offset)
+        self.offset += 3*count
+        return result
+
+
+class Writer(object):
+    """Append-only counterpart of Reader that encodes into a bytearray.
+
+    It has a file-like write() and tell(), so the write_* functions work
+    on it as well as on real files.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def write(self, data):
+        self.buf += data
+        return len(data)
+
+    def tell(self):
+        return len(self.buf)
+
+    def getvalue(self):
+        return self.buf
+
+    def pack(self, fmt, *values):
+        self.buf += get_struct(fmt).pack(*values)
+
+    def u8(self, value):
+        self.buf += U8.pack(value)
+
+    def u16(self, value):
+        self.buf += U16.pack(value)
+
+    def u32(self, value):
+        self.buf += U32.pack(value)
+
+    def i32(self, value):
+        self.buf += I32.pack(value)
+
+    def f32(self, value):
+        self.buf += F32.pack(value)
+
+    def vsval(self, value):
+        self.buf += encode_vsval(value)
+
+    def wstring(self, s, z=False):
+        if z:
+            s += b'\x00'
+        self.buf += U16.pack(len(s))
+        self.buf += s
+
+    def refid(self, refid):
+        flag, value = refid
+        self.buf.append((value >> 16) + (flag << 6))
+        self.buf.append((value & 0xff00) >> 8)
+        self.buf.append(value & 0xff)
+
+    def refids(self, flags, values):
+        self.buf += encode_refids(flags, values)
+
+
 def parse_misc_stats(data, size, name):
-    misc_stats = defaultdict(list)
-    count, = unpack('I', data.read(4))
+    """The stats as a list of MiscStat in file order. category is the raw
+    id; StatCategoryNames maps the known ones to a name."""
+    misc_stats = list()
+    count = data.u32()
 
     for n in range(count):
-        name = parse_wstring(data)
-        category, = unpack('B', data.read(1))
-        value, = unpack('i', data.read(4))
-        misc_stats[StatCategoryNames.get(category, 'Unknown')].append((name, value))
-    return dict(misc_stats)
+        name = data.wstring()
+        category, value = data.unpack('Bi')
+        misc_stats.append(MiscStat(name, category, value))
+    return misc_stats
 
 def write_misc_stats(filehandle, misc_stats):
-    length = sum([len(l) for l in list(misc_stats.values())])
-    filehandle.write(pack('I', length))
-    for category, values in list(misc_stats.items()):
-        for name, value in values:
-            write_wstring(filehandle, name)
-            filehandle.write(pack('B', category))
-            filehandle.write(pack('i', value))
+    filehandle.write(pack('I', len(misc_stats)))
+    for name, category, value in misc_stats:
+        write_wstring(filehandle, name)
+        filehandle.write(pack('<Bi', category, value))
 
     return True
 
@@ -281,7 +494,7 @@ def parse_player_loc_old(data, size, name):
 def write_player_loc_old(filehandle, loc):
     filehandle.write(pack('I', loc[0]))
     write_refid(filehandle, loc[1])
-    filehandle.write(pack('II', *loc[2]))
+    filehandle.write(pack('4I', *loc[2]))
     write_refid(filehandle, loc[3])
     filehandle.write(pack('I', loc[4]))
     return True
@@ -296,11 +509,13 @@ def parse_player_loc(data, size, name):
     return [nextObjectId, worldSpace1, cx, cy, worldSpace2, x, y, z, unknown2]
 
 def write_player_loc(filehandle, loc):
-    filehandle.write(pack('I', loc[0]))
-    write_refid(filehandle, loc[1])
-    filehandle.write(pack('II', *loc[2]))
-    write_refid(filehandle, loc[3])
-    filehandle.write(pack('I', loc[4]))
+    nextObjectId, worldSpace1, cx, cy, worldSpace2, x, y, z, unknown2 = loc
+    filehandle.write(pack('I', nextObjectId))
+    write_refid(filehandle, worldSpace1)
+    filehandle.write(pack('II', cx, cy))
+    write_refid(filehandle, worldSpace2)
+    filehandle.write(pack('fff', x, y, z))
+    filehandle.write(pack('B', unknown2))
     return True
 
 def parse_tes(filehandle, size, name):
@@ -309,28 +524,25 @@ def parse_tes(filehandle, size, name):
     begin = filehandle.tell()
     data = filehandle
     list1 = parse_tes_list1(data)
-    list2 = list()
-    list3 = list()
     #count = parse_vsval(data)
     count, = unpack('I', data.read(4))
     print(("second count %r" % count))
-    for i in range(count):
-        refid = parse_refid(data)
-        list2.append(refid)
-        print((filehandle.tell()))
+    flags, values = parse_refids(data, count)
+    list2 = list(zip(flags.tolist(), values.tolist()))
     count = parse_vsval(data)
     print(("third count %r" % count))
 
-    for i in range(count):
-        list3.append(parse_refid(data))
+    flags, values = parse_refids(data, count)
+    list3 = list(zip(flags.tolist(), values.tolist()))
     print(("parse tes %r %r %r" % (len(list1), len(list2), len(list3))))
     end = filehandle.tell()
     extra_len = (end-begin) - size
     print(("parsed %s of %s bytes %r" % (end-begin, size, extra_len)))
     if -extra_len > 0:
         extra = data.read(-extra_len)
-        with open('dump/' + 'tes_extra', 'wb') as f:
-            f.write(extra)
+        if DUMP_DIR and os.path.isdir(DUMP_DIR):
+            with open(os.path.join(DUMP_DIR, 'tes_extra'), 'wb') as f:
+                f.write(extra)
 
     return list1, list2, list3
 
@@ -343,24 +555,19 @@ def write_tes(filehandle, tes):
         filehandle.write(pack('H', u))
 
     filehandle.write(pack('I', len(tes[1])))
-    for refid in tes[1]:
-        write_refid(filehandle, refid)
+    write_refids(filehandle, *split_refids(tes[1]))
 
     write_vsval(filehandle, len(tes[2]))
-    for refid in tes[2]:
-        write_refid(filehandle, refid)
+    write_refids(filehandle, *split_refids(tes[2]))
 
 
 def parse_globals(data, size, name):
     result = OrderedDict()
-    count = parse_vsval(data)
+    count = data.vsval()
     log.debug("globals count: {}".format(count))
-    #sys.exit(8)
     for g in range(count):
-        refid = parse_refid(data)
-        value, = unpack('f', data.read(4))
-        result[refid] = value
-        print(refid, value)
+        refid = data.refid()
+        result[refid] = data.f32()
     return result
 
 
@@ -372,25 +579,20 @@ def write_globals(filehandle, global_data):
 
 
 def parse_refid_list(data):
-    count = parse_vsval(data)
-    print("c", count)
-    result = list()
-    for c in range(count):
-        value = parse_refid(data)
-        result.append(value)
-
-    return result
+    count = data.vsval()
+    flags, values = data.refids(count)
+    return list(zip(flags.tolist(), values.tolist()))
 
 
 def parse_effects(data, size, name):
-    count = parse_vsval(data)
+    count = data.vsval()
     effects = list()
     for i in range(count):
-        strength, timestamp, unknown = unpack('ffI', data.read(12))
-        refid = parse_refid(data)
+        strength, timestamp, unknown = data.unpack('ffI')
+        refid = data.refid()
         effects.append((strength, timestamp, unknown, refid))
 
-    unknown1, unknown2 = unpack('ff', data.read(8))
+    unknown1, unknown2 = data.unpack('ff')
     return [effects, unknown1, unknown2]
 
 
@@ -423,56 +625,267 @@ def parse_audio(data, size, name):
 
 def parse_skycells(data, size, name):
     count = parse_vsval(data)
-    cells = list()
-    for i in range(count):
-        cell1 = parse_refid(data)
-        cell2 = parse_refid(data)
-        cells.append((cell1, cell2))
-
-    return cells
+    flags, values = parse_refids(data, 2*count)
+    refids = list(zip(flags.tolist(), values.tolist()))
+    return list(zip(refids[0::2], refids[1::2]))
 
 
 def parse_interface(data, size, name):
-    shownHelpMsgCount, = unpack('I', data.read(4))
-    print(shownHelpMsgCount)
-    shownHelpMsgs = list()
-    for c in range(shownHelpMsgCount):
-        shownHelpMsg, = unpack('I', data.read(4))
-        shownHelpMsgs.append(shownHelpMsg)
-
-    unknown0, = unpack('B', data.read(1))
-    print(shownHelpMsgs)
-    print("unknown0", unknown0)
+    shownHelpMsgCount = data.u32()
+    shownHelpMsgs = list(data.unpack('%dI' % shownHelpMsgCount))
+
+    unknown0 = data.u8()
     lastUsedWeapons = parse_refid_list(data)
     lastUsedSpells = parse_refid_list(data)
     lastUsedShouts = parse_refid_list(data)
 
-    unknown1, = unpack('B', data.read(1))
+    unknown1 = data.u8()
 
-    count1 = parse_vsval(data)
-    print(count1)
+    count1 = data.vsval()
     sl1 = list()
     for i in range(count1):
-        us1 = parse_wstring(data)
-        us2 = parse_wstring(data)
-        unknown_ints = unpack('4I', data.read(16))
+        us1 = data.wstring()
+        us2 = data.wstring()
+        unknown_ints = data.unpack('4I')
         sl1.append((us1, us2, unknown_ints))
 
-    count2 = parse_vsval(data)
-    print(count2)
+    count2 = data.vsval()
     sl2 = list()
     for i in range(count2):
-        us3 = parse_wstring(data)
-        sl2.append(us3)
+        sl2.append(data.wstring())
 
-    unknown3, = unpack('I', data.read(4))
+    unknown3 = data.u32()
     return [shownHelpMsgs, unknown0, lastUsedWeapons, lastUsedSpells, lastUsedShouts, unknown1, sl1, sl2, unknown3]
 
 
+PapyrusScript = namedtuple('PapyrusScript', 'name type members')
+PapyrusInstance = namedtuple('PapyrusInstance', 'id script unknown2bits unknown0 refid unknown1')
+PapyrusData = namedtuple('PapyrusData', 'id flag type unknown1 unknown2 members')
+PapyrusInstanceStruct = Struct('<IHHh3sB')
+
+# Size of a Papyrus variable's value, by variable type
+PapyrusVariableSizes = {0: 4, # null
+                        1: 6, # object: type, id
+                        2: 2, # string
+                        3: 4, # int
+                        4: 4, # float
+                        5: 4, # bool
+                        11: 6, # object array: type, array id
+                        12: 4, 13: 4, 14: 4, 15: 4} # array ids
+
+
+class Papyrus(object):
+    """Index of the Papyrus global data (type 1001).
+
+    Construction walks the tables once: the string table is kept as
+    offsets, the script instances, references, arrays and active scripts
+    as array columns, and only the (small) script definitions are
+    decoded. The instance, reference and array data that follow are
+    indexed by id on first use and decoded one entry at a time. The
+    active scripts' stack frames are not parsed; active_data_offset
+    marks where they start.
+    """
+
+    def __init__(self, buf):
+        self.raw = memoryview(buf)
+        data = Reader(self.raw)
+        self.version, string_count = data.unpack('HH')
+
+        self.string_offsets = array('I')
+        for i in range(string_count):
+            self.string_offsets.append(data.tell())
+            data.skip(data.u16())
+
+        self.scripts = OrderedDict()
+        for i in range(data.u32()):
+            name, type, member_count = data.unpack('HHI')
+            members = data.unpack('%dH' % (2 * member_count))
+            self.scripts[name] = PapyrusScript(name, type, tuple(zip(members[0::2], members[1::2])))
+
+        count = data.u32()
+        self.instance_ids = array('I')
+        self.instance_scripts = array('H')
+        self.instance_refids = array('I') # packed as (flag << 22) | value
+        self.instance_offsets = array('I')
+        for i in range(count):
+            offset = data.tell()
+            instance_id, script, _, _, refid, _ = PapyrusInstanceStruct.unpack_from(self.raw, offset)
+            data.skip(PapyrusInstanceStruct.size)
+            self.instance_offsets.append(offset)
+            self.instance_ids.append(instance_id)
+            self.instance_scripts.append(script)
+            self.instance_refids.append((refid[0] << 16) | (refid[1] << 8) | refid[2])
+
+        self.reference_ids = array('I')
+        self.reference_types = array('H')
+        for i in range(data.u32()):
+            reference_id, type = data.unpack('IH')
+            self.reference_ids.append(reference_id)
+            self.reference_types.append(type)
+
+        self.array_ids = array('I')
+        self.array_types = array('B')
+        self.array_lengths = array('I')
+        for i in range(data.u32()):
+            array_id, type = data.unpack('IB')
+            if type == 1:
+                data.skip(2) # reference type
+            self.array_ids.append(array_id)
+            self.array_types.append(type)
+            self.array_lengths.append(data.u32())
+
+        self.runtime = data.u32()
+        self.active_ids = array('I')
+        self.active_types = array('B')
+        for i in range(data.u32()):
+            active_id, type = data.unpack('IB')
+            self.active_ids.append(active_id)
+            self.active_types.append(type)
+
+        self.data_offset = data.tell()
+        self.active_data_offset = None
+        self._instance_index = None
+        self._instance_data = None
+        self._reference_data = None
+        self._array_data = None
+
+    def __eq__(self, other):
+        return isinstance(other, Papyrus) and self.raw == other.raw
+
+    def __ne__(self, other):
+        return not self == other
+
+    def string(self, index):
+        offset = self.string_offsets[index]
+        size = unpack('<H', self.raw[offset:offset+2])[0]
+        return bytes(self.raw[offset+2:offset+2+size])
+
+    def __len__(self):
+        return len(self.instance_ids)
+
+    def instance(self, position):
+        instance_id, script, unknown2bits, unknown0, refid, unknown1 = \
+            PapyrusInstanceStruct.unpack_from(self.raw, self.instance_offsets[position])
+        return PapyrusInstance(instance_id, self.string(script), unknown2bits, unknown0,
+                               Reader(refid).refid(), unknown1)
+
+    def instances(self):
+        for position in range(len(self)):
+            yield self.instance(position)
+
+    def find_instance(self, instance_id):
+        """The PapyrusInstance with instance_id, or None."""
+        if self._instance_index is None:
+            self._instance_index = dict((instance_id, position) for position, instance_id
+                                        in enumerate(self.instance_ids))
+        position = self._instance_index.get(instance_id)
+        if position is None:
+            return None
+        return self.instance(position)
+
+    def orphaned_instances(self):
+        """Instances whose script is not defined in the save, or that are
+        not attached to any form (null RefID)."""
+        for position, (script, refid) in enumerate(zip(self.instance_scripts, self.instance_refids)):
+            if script not in self.scripts or refid == 0:
+                yield self.instance(position)
+
+    def _skip_variables(self, data, count):
+        for i in range(count):
+            data.skip(PapyrusVariableSizes[data.u8()])
+
+    def _skip_object_data(self, data):
+        object_id, flag = data.unpack('IB')
+        data.skip(6 if flag & 0x04 else 2)
+        data.skip(4)
+        self._skip_variables(data, data.u32())
+        return object_id
+
+    def _index_data(self):
+        data = Reader(self.raw, self.data_offset)
+        self._instance_data = dict()
+        for i in range(len(self.instance_ids)):
+            offset = data.tell()
+            self._instance_data[self._skip_object_data(data)] = offset
+        self._reference_data = dict()
+        for i in range(len(self.reference_ids)):
+            offset = data.tell()
+            self._reference_data[self._skip_object_data(data)] = offset
+        self._array_data = dict()
+        for length in self.array_lengths:
+            offset = data.tell()
+            self._array_data[data.u32()] = offset
+            self._skip_variables(data, length)
+        self.active_data_offset = data.tell()
+
+    def _variables(self, data, count):
+        result = list()
+        for i in range(count):
+            type = data.u8()
+            if type in (1, 11):
+                value = data.unpack('HI')
+            elif type == 2:
+                value = self.string(data.u16())
+            elif type == 3:
+                value = data.i32()
+            elif type == 4:
+                value = data.f32()
+            else:
+                value = data.u32()
+            result.append((type, value))
+        return result
+
+    def _object_data(self, offset):
+        data = Reader(self.raw, offset)
+        object_id, flag, type, unknown1 = data.unpack('IBHI')
+        unknown2 = data.u32() if flag & 0x04 else None
+        members = self._variables(data, data.u32())
+        return PapyrusData(object_id, flag, self.string(type), unknown1, unknown2, members)
+
+    def instance_data(self, instance_id):
+        """The PapyrusData (member variables) of a script instance."""
+        if self._instance_data is None:
+            self._index_data()
+        return self._object_data(self._instance_data[instance_id])
+
+    def reference_data(self, reference_id):
+        if self._reference_data is None:
+            self._index_data()
+        return self._object_data(self._reference_data[reference_id])
+
+    def array_data(self, array_id):
+        """The (type, value) elements of an array."""
+        if self._array_data is None:
+            self._index_data()
+        offset = self._array_data[array_id]
+        position = self.array_ids.index(array_id)
+        return self._variables(Reader(self.raw, offset + 4), self.array_lengths[position])
+
+
+def parse_papyrus(data, size, name):
+    view = data.view(size)
+    try:
+        return Papyrus(view)
+    except (error, IndexError, KeyError) as e:
+        log.warning("Can't parse {}, keeping it as bytes: {}".format(name, e))
+        return bytes(view)
+
+
+def write_papyrus(filehandle, papyrus):
+    if isinstance(papyrus, Papyrus):
+        papyrus = papyrus.raw
+    filehandle.write(papyrus)
+    return True
+
+
+# Unparsed global data items are written here for inspection, if the
+# directory exists.  Set to None to turn dumping off.
+DUMP_DIR = 'dump'
+
 def parse_dummy(data, size, name, dump=True):
     contents = data.read(size)
-    if dump:
-        with open('dump/' + name, 'wb') as f:
+    if dump and DUMP_DIR and os.path.isdir(DUMP_DIR):
+        with open(os.path.join(DUMP_DIR, name), 'wb') as f:
             f.write(contents)
     return contents
 
@@ -506,7 +919,7 @@ GlobalDataTypeParsers = {0: ('Misc Stats', parse_misc_stats, write_misc_stats),
                          113: ('Menu Controls', parse_dummy, write_dummy),
                          114: ('MenuTopicManager', parse_dummy, write_dummy),
                          1000: ('Temp Effects', parse_dummy, write_dummy),
-                         1001: ('Papyrus', parse_dummy, write_dummy),
+                         1001: ('Papyrus', parse_papyrus, write_papyrus),
                          1002: ('Anim Objects', parse_dummy, write_dummy),
                          1003: ('Timer', parse_dummy, write_dummy),
                          1004: ('Synchronized Animations', parse_dummy, write_dummy),
@@ -517,12 +930,7 @@ GlobalDataTypeParsers_pre9 = GlobalDataTypeParsers.copy()
 GlobalDataTypeParsers_pre9[1] = ('Player Location', parse_player_loc_old, write_player_loc_old)
 
 def parse_refid(data):
-    byte0, byte1, byte2 = unpack('BBB', data.read(3))
-    flag = byte0 >> 6
-    assert(flag >= 0)
-    assert(flag <= 3)
-    value = ((byte0 & 63) << 16) + (byte1 << 8) + byte2
-    return flag, ((byte0 & 63) << 16) + (byte1 << 8) + byte2
+    return data.refid()
 
 
 def write_refid(filehandle, refid):
@@ -533,55 +941,123 @@ def write_refid(filehandle, refid):
     filehandle.write(pack('BBB', byte0, byte1, byte2))
     return True
 
-def parse_vsval(data):
-    r = parse_vsval_r(data)
-    print(("vsval: %r" % r))
-    return r
-
-def parse_vsval_r(data):
-    print(("vsval tell: %r" % data.tell()))
-    byte0, = unpack('B', data.read(1))
-    flag = byte0 & 3
-    print(("vsval type: %r" % flag))
-    print(("vsval byte0: %r" % bin(byte0)))
-    data.seek(-1, os.SEEK_CUR)
-    if flag == 0:
-        #return (unpack('B', data.read(1))[0]) >> 2
-        byte0, = unpack('B', data.read(1))
-        return byte0 >> 2
-    elif flag == 1:
-        #return unpack('H', data.read(2))[0] >> 2
-        byte0, byte1 = unpack('BB', data.read(2))
-        #byte1, = unpack('B', data.read(1))
-        print(("vsval byte0: %r" % byte0))
-        print(("vsval byte1: %r" % byte1))
-        print(((byte1 << 8) + byte0) >> 2)
-        return ((byte1 << 8) + byte0) >> 2
-    elif flag == 2:
-        #return unpack('I', data.read(4))[0] >> 2
-        byte1, byte2, byte3 = unpack('BBB', data.read(3))
-        print(("vsval byte2: %r" % byte2))
-        print(("vsval byte3: %r" % byte3))
-        return ((byte3 << 24) + (byte2 << 16) + (byte1 << 8) + byte0) >> 2
-        #return ((byte0 >> 2) << 24) + (byte1 << 16) + (byte2 << 8) + byte3
+def decode_refids(buf, count, offset=0):
+    """Decode count consecutive RefIDs from buf in one pass.
+
+    Returns the (flags, values) arrays: numpy uint8/uint32 arrays when
+    numpy is available, array('B')/array('I') otherwise.
+    """
+    if numpy is not None:
+        raw = numpy.frombuffer(buf, dtype=numpy.uint8, count=3*count, offset=offset).reshape(count, 3)
+        byte0 = raw[:, 0]
+        flags = byte0 >> 6
+        values = (((byte0 & 63).astype(numpy.uint32) << 16) |
+                  (raw[:, 1].astype(numpy.uint32) << 8) |
+                  raw[:, 2])
+        return flags, values
+
+    raw = bytes(buf[offset:offset+3*count])
+    byte0, byte1, byte2 = raw[0::3], raw[1::3], raw[2::3]
+    flags = array('B', [b >> 6 for b in byte0])
+    values = array('I', [((b0 & 63) << 16) | (b1 << 8) | b2
+                         for b0, b1, b2 in zip(byte0, byte1, byte2)])
+    return flags, values
+
+
+def encode_refids(flags, values):
+    """Encode parallel flag and value sequences as packed RefIDs."""
+    if numpy is not None:
+        flags = numpy.asarray(flags, dtype=numpy.uint32)
+        values = numpy.asarray(values, dtype=numpy.uint32)
+        raw = numpy.empty((len(values), 3), dtype=numpy.uint8)
+        raw[:, 0] = (values >> 16) + (flags << 6)
+        raw[:, 1] = (values & 0xff00) >> 8
+        raw[:, 2] = values & 0xff
+        return raw.tobytes()
+
+    raw = bytearray(3*len(values))
+    raw[0::3] = bytes([(value >> 16) + (flag << 6) for flag, value in zip(flags, values)])
+    raw[1::3] = bytes([(value & 0xff00) >> 8 for value in values])
+    raw[2::3] = bytes([value & 0xff for value in values])
+    return bytes(raw)
+
+
+def refids_to_formids(flags, values, formIDArray):
+    """Resolve RefIDs to formids in one pass.
+
+    Flag 0 is a 1-based index into formIDArray (0 is the null form),
+    1 a formid of the base game and 2 a created form, 0xFF000000 | value.
+    """
+    if numpy is not None:
+        flags = numpy.asarray(flags, dtype=numpy.uint32)
+        values = numpy.asarray(values, dtype=numpy.uint32)
+        table = numpy.concatenate([numpy.zeros(1, dtype=numpy.uint32),
+                                   numpy.asarray(formIDArray, dtype=numpy.uint32)])
+        indexed = numpy.where(values < len(table), table[numpy.minimum(values, len(table) - 1)], 0)
+        return numpy.where(flags == 0, indexed,
+                           numpy.where(flags == 2, values | 0xFF000000, values))
+
+    result = array('I')
+    for flag, value in zip(flags, values):
+        if flag == 0:
+            result.append(formIDArray[value-1] if 0 < value <= len(formIDArray) else 0)
+        elif flag == 2:
+            result.append(value | 0xFF000000)
+        else:
+            result.append(value)
+    return result
+
+
+def split_refids(refids):
+    """[(flag, value), ...] -> (flags, values)"""
+    flags = [flag for flag, value in refids]
+    values = [value for flag, value in refids]
+    return flags, values
+
+
+def parse_refids(data, count):
+    return data.refids(count)
+
+
+def write_refids(filehandle, flags, values):
+    filehandle.write(encode_refids(flags, values))
+    return True
+
+
+def parse_uint32_array(buf, count, offset=0):
+    """count uint32 from buf, as a numpy array sharing buf's memory when
+    numpy is available."""
+    if numpy is not None:
+        return numpy.frombuffer(buf, dtype='<u4', count=count, offset=offset)
+    result = array('I')
+    result.frombytes(bytes(buf[offset:offset+4*count]))
+    if sys.byteorder == 'big':
+        result.byteswap()
+    return result
+
+
+def write_uint32_array(filehandle, values):
+    filehandle.write(pack('I', len(values)))
+    if numpy is not None:
+        filehandle.write(numpy.asarray(values, dtype='<u4').tobytes())
     else:
-        print("error in parse_vsval")
-        sys.exit(8)
+        filehandle.write(pack('%sI' % len(values), *values))
 
-def write_vsval(filehandle, value):
+
+def parse_vsval(data):
+    return data.vsval()
+
+def encode_vsval(value):
     if value < 0x40:
-        filehandle.write(pack('B', (value << 2) & 0b11111100))
+        return U8.pack(value << 2)
     elif value < 0x4000:
-        byte0 = ((value << 2) & 0b11111100) + 1
-        filehandle.write(pack('B', byte0))
-        byte1 = (0xff & (value >> 6))
-        filehandle.write(pack('B', byte1))
-
+        return U16.pack((value << 2) | 1)
     elif value < 0x40000000:
-        filehandle.write(pack('B', (0xff & ((value << 2) + 2))))
-        filehandle.write(pack('B', (0xff & (value >> 6))))
-        filehandle.write(pack('B', (0xff & (value >> 14))))
-        filehandle.write(pack('B', (0xff & (value >> 22))))
+        return U32.pack((value << 2) | 2)
+    raise ValueError("vsval out of range: %r" % value)
+
+def write_vsval(filehandle, value):
+    filehandle.write(encode_vsval(value))
 
 
 def parse_tes_list1(data):
@@ -598,21 +1074,41 @@ def parse_tes_list1(data):
     return result
 
 
-def parse_filetime(filehandle):
-    t = unpack('II', filehandle.read(8))
-    win_epoch = datetime.datetime(1601, 1, 1, 0, 0, 0)
-    ts = (t[1] << 32) | t[0]
+WinEpoch = datetime.datetime(1601, 1, 1, 0, 0, 0)
+Microsecond = datetime.timedelta(microseconds=1)
 
-    return win_epoch + datetime.timedelta(microseconds=ts/10)
+class FileTime(datetime.datetime):
+    # A datetime that remembers the 100ns FILETIME tick count it was read
+    # from, so that an unchanged time is written back exactly. Arithmetic
+    # returns plain datetimes, which drops the ticks.
+    ticks = None
+
+    def __reduce_ex__(self, protocol):
+        # datetime pickles only its fields; rebuild from the ticks instead
+        # so cached and pool-returned headers keep them.
+        if self.ticks is None:
+            return super().__reduce_ex__(protocol)
+        return filetime_from_ticks, (self.ticks,)
+
+
+def filetime_from_ticks(ticks):
+    dt = WinEpoch + datetime.timedelta(microseconds=ticks // 10)
+    result = FileTime(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.microsecond)
+    result.ticks = ticks
+    return result
+
+
+def parse_filetime(filehandle):
+    t = filehandle.unpack('II')
+    return filetime_from_ticks((t[1] << 32) | t[0])
 
 
 def write_filetime(filehandle, dt):
-    ticks = time.mktime(dt.timetuple())
-    win_epoch = datetime.datetime(1601, 1, 1, 0, 0, 0)
-    unix_epoch = datetime.datetime(1970, 1, 1, 0, 0, 0)
-    dt += (unix_epoch - win_epoch)
-    win_ticks = int(time.mktime(dt.timetuple())) * 10000000
-    filehandle.write(pack('II', dt.microsecond * 10, (win_ticks >> 32)))
+    microseconds = (dt.replace(tzinfo=None) - WinEpoch) // Microsecond
+    ticks = getattr(dt, 'ticks', None)
+    if ticks is None or ticks // 10 != microseconds:
+        ticks = microseconds * 10
+    filehandle.write(pack('II', ticks & 0xffffffff, ticks >> 32))
 
 
 def write_wstring(filehandle, s, z=False):
@@ -626,17 +1122,11 @@ def write_wstring(filehandle, s, z=False):
 
 
 def parse_wstring(filehandle, z=False):
-    # A string prefixed with a uint16 length and optionally terminated with a zero (\x00).
-    length, = unpack('H', filehandle.read(2))
-    s = filehandle.read(length)
-    if z:
-        return s[:-1]
-    else:
-        return s
+    return filehandle.wstring(z)
 
 
 def parse_screenshot(filehandle, write_to_file=None):
-    width, height = unpack('II', filehandle.read(8))
+    width, height = filehandle.unpack('II')
     rgb_data = filehandle.read(3*width*height)
     if write_to_file:
         im = Image.frombuffer('RGB', (width, height), rgb_data, 'raw', 'RGB', 0, 1)
@@ -645,23 +1135,17 @@ def parse_screenshot(filehandle, write_to_file=None):
 
 
 def parse_record(filehandle):
-    refId = parse_refid(filehandle)
-    flags, = unpack('I', filehandle.read(4))
-    rt, = unpack('B', filehandle.read(1))
+    refId = filehandle.refid()
+    flags, rt, version = filehandle.unpack('IBB')
     data_length_size = rt >> 6
     record_type = rt & 63
 
-    version, = unpack('B', filehandle.read(1))
-    if data_length_size == 0:
-        datasize1, datasize2 = unpack('BB', filehandle.read(2))
-    elif data_length_size == 1:
-        datasize1, datasize2 = unpack('HH', filehandle.read(4))
-    elif data_length_size == 2:
-        datasize1, datasize2 = unpack('II', filehandle.read(8))
-    else:
+    try:
+        datasize1, datasize2 = filehandle.unpack(('BB', 'HH', 'II')[data_length_size])
+    except IndexError:
         raise Exception("Strange datasize: %r" % data_length_size)
 
-    data = filehandle.read(datasize1)
+    data = filehandle.view(datasize1)
 
     return Record._make([refId, flags, savegameform_to_form[record_type], version, datasize1, datasize2, data])
 
@@ -670,20 +1154,14 @@ def write_record(filehandle, record):
     write_refid(filehandle, record.formid)
     filehandle.write(pack('I', record.changeflags))
 
-    # Handle compressed data like this for now
-    if record.length2 > 0:
-        datasize = record.length2
-    else:
-        datasize = len(record.data)
-
+    # Both lengths share one field width.
+    datasize = len(record.data)
+    largest = max(datasize, record.length2)
     size_bits = 0
-    if datasize > 0xff:
-        size_bits = 1
-    elif datasize > 0xffff:
+    if largest > 0xffff:
         size_bits = 2
-
-    # Now the size_bits are calculated, reset to proper size
-    datasize = len(record.data)
+    elif largest > 0xff:
+        size_bits = 1
 
     record_type = (size_bits << 6) + form_to_savegameform[record.type]
     filehandle.write(pack('B', record_type))
@@ -700,17 +1178,334 @@ def write_record(filehandle, record):
     return True
 
 
+ChangeFormHeader = Struct('<BBBIBB')
+ChangeFormLengths = {0: Struct('<BB'), 1: Struct('<HH'), 2: Struct('<II')}
+BODY_CACHE_BYTES = 64 << 20
+
+
+class ChangeFormTable(object):
+    """The change forms of a save, kept as memoryview slices of the buffer
+    they were read from.
+
+    The record headers are scanned once into parallel array columns; the
+    record bodies are never copied. Indexes by formid, form type and change
+    flag bit are built on first use, so lookups are dict hits instead of
+    linear scans. Indexing the table yields Record tuples whose data is a
+    memoryview.
+
+    Records can be replaced or appended; the table remembers which ones,
+    so spans() can describe the section as untouched source byte ranges
+    plus the encoded modified records.
+
+    body() returns the uncompressed data of a record, decompressing it on
+    first access; bodies are kept in an LRU cache of at most
+    body_cache_bytes.
+    """
+
+    def __init__(self, buf, offset, count):
+        self._buffer = memoryview(buf)
+        self.begin = offset
+        self.formids = array('I')
+        self.changeflags = array('I')
+        self.types = array('H')
+        self.versions = array('B')
+        self.length1 = array('I')
+        self.length2 = array('I')
+        self.offsets = array('I')
+        self.ends = array('I')
+        self._replaced = dict()
+        self._digests = None
+        self._by_formid = None
+        self._by_type = None
+        self._by_flag = None
+        self._bodies = OrderedDict()
+        self._body_bytes = 0
+        self.body_cache_bytes = BODY_CACHE_BYTES
+
+        unpack_header = ChangeFormHeader.unpack_from
+        for c in range(count):
+            byte0, byte1, byte2, flags, rt, version = unpack_header(buf, offset)
+            lengths = ChangeFormLengths.get(rt >> 6)
+            if lengths is None:
+                raise Exception("Strange datasize: %r" % (rt >> 6))
+            datasize1, datasize2 = lengths.unpack_from(buf, offset + 9)
+            offset += 9 + lengths.size
+
+            self.formids.append((byte0 << 16) | (byte1 << 8) | byte2)
+            self.changeflags.append(flags)
+            self.types.append(savegameform_to_form[rt & 63])
+            self.versions.append(version)
+            self.length1.append(datasize1)
+            self.length2.append(datasize2)
+            self.offsets.append(offset)
+            offset += datasize1
+            self.ends.append(offset)
+        self.end = offset
+
+    def __len__(self):
+        return len(self.formids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if self._replaced and index in self._replaced:
+            return self._replaced[index]
+        formid = self.formids[index]
+        offset = self.offsets[index]
+        return Record((formid >> 22, formid & 0x3fffff),
+                      self.changeflags[index],
+                      self.types[index],
+                      self.versions[index],
+                      self.length1[index],
+                      self.length2[index],
+                      self._buffer[offset:offset+self.length1[index]])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __setitem__(self, index, record):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        flag, value = record.formid
+        self.formids[index] = (flag << 22) | value
+        self.changeflags[index] = record.changeflags
+        self.types[index] = record.type
+        self.versions[index] = record.version
+        self.length1[index] = len(record.data)
+        self.length2[index] = record.length2
+        self._replaced[index] = record._replace(length1=len(record.data))
+        self._by_formid = self._by_type = self._by_flag = None
+        self._digests = None
+        body = self._bodies.pop(index, None)
+        if body is not None:
+            self._body_bytes -= len(body)
+
+    def append(self, record):
+        for column in (self.formids, self.changeflags, self.types, self.versions,
+                       self.length1, self.length2):
+            column.append(0)
+        self[len(self) - 1] = record
+
+    def _decompress(self, index):
+        record = self[index]
+        if record.length2:
+            return zlib.decompress(record.data, 15, record.length2)
+        return bytes(record.data)
+
+    def _cache_body(self, index, body):
+        if len(body) > self.body_cache_bytes:
+            return
+        cache = self._bodies
+        old = cache.pop(index, None)
+        if old is not None:
+            self._body_bytes -= len(old)
+        cache[index] = body
+        self._body_bytes += len(body)
+        self._trim_bodies()
+
+    def _trim_bodies(self):
+        cache = self._bodies
+        while self._body_bytes > self._body_cache_bytes:
+            self._body_bytes -= len(cache.popitem(last=False)[1])
+
+    @property
+    def body_cache_bytes(self):
+        return self._body_cache_bytes
+
+    @body_cache_bytes.setter
+    def body_cache_bytes(self, value):
+        self._body_cache_bytes = value
+        self._trim_bodies()
+
+    def body(self, index):
+        """The uncompressed data of the record at index."""
+        if index < 0:
+            index += len(self)
+        body = self._bodies.get(index)
+        if body is not None:
+            self._bodies.move_to_end(index)
+            return body
+        body = self._decompress(index)
+        self._cache_body(index, body)
+        return body
+
+    def decompress_type(self, type, workers=None):
+        """{position: uncompressed data} of every record of the form type.
+
+        Bodies not in the cache are decompressed in batches on a thread
+        pool; zlib releases the GIL, so this uses every core.
+        """
+        positions = self.positions_of_type(type)
+        bodies = OrderedDict()
+        missing = list()
+        for index in positions:
+            body = self._bodies.get(index)
+            if body is None:
+                missing.append(index)
+            else:
+                self._bodies.move_to_end(index)
+            bodies[index] = body
+
+        def decompress_batch(batch):
+            return [self._decompress(index) for index in batch]
+
+        batches = [missing[i:i+256] for i in range(0, len(missing), 256)]
+        if batches:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for batch, results in zip(batches, pool.map(decompress_batch, batches)):
+                    for index, body in zip(batch, results):
+                        bodies[index] = body
+                        self._cache_body(index, body)
+        return bodies
+
+    @property
+    def modified(self):
+        return bool(self._replaced)
+
+    def __eq__(self, other):
+        if (isinstance(other, ChangeFormTable) and
+            not self.modified and not other.modified):
+            return self.raw() == other.raw()
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def raw(self):
+        """The encoded change forms section as a memoryview."""
+        if self.modified:
+            raise ValueError("ChangeFormTable has modified records")
+        return self._buffer[self.begin:self.end]
+
+    def spans(self):
+        """The encoded section as a sequence of (start, end) byte ranges of
+        unmodified records in the source buffer and bytes of the encoded
+        modified ones."""
+        count = len(self.offsets)
+        run_start = self.begin
+        appended = list()
+        for index in sorted(self._replaced):
+            if index >= count:
+                appended.append(index)
+                continue
+            start = self.ends[index-1] if index else self.begin
+            if start > run_start:
+                yield (run_start, start)
+            w = Writer()
+            write_record(w, self._replaced[index])
+            yield w.getvalue()
+            run_start = self.ends[index]
+        if self.end > run_start:
+            yield (run_start, self.end)
+        for index in appended:
+            w = Writer()
+            write_record(w, self._replaced[index])
+            yield w.getvalue()
+
+    def buffers(self):
+        """Like spans(), with the ranges as memoryviews of the source."""
+        for span in self.spans():
+            if isinstance(span, tuple):
+                yield self._buffer[span[0]:span[1]]
+            else:
+                yield span
+
+    def _build_indexes(self):
+        by_formid = dict()
+        by_type = defaultdict(lambda: array('I'))
+        by_flag = defaultdict(lambda: array('I'))
+        for index, (formid, type, flags) in enumerate(zip(self.formids, self.types,
+                                                          self.changeflags)):
+            by_formid[formid] = index
+            by_type[type].append(index)
+            while flags:
+                bit = flags & -flags
+                by_flag[bit].append(index)
+                flags ^= bit
+        self._by_formid = by_formid
+        self._by_type = dict(by_type)
+        self._by_flag = dict(by_flag)
+
+    def index(self, formid):
+        """Position of the change form with the (flag, value) formid."""
+        if self._by_formid is None:
+            self._build_indexes()
+        flag, value = formid
+        return self._by_formid[(flag << 22) | value]
+
+    def formid_positions(self):
+        """{formid: position}, with formids packed as (flag << 22) | value."""
+        if self._by_formid is None:
+            self._build_indexes()
+        return self._by_formid
+
+    def digest(self, index):
+        """A cheap fingerprint of a record: its header fields and the crc32
+        of its data. The crc32s are computed once for the whole table."""
+        if self._digests is None:
+            crc32 = zlib.crc32
+            buf = self._buffer
+            digests = array('I')
+            for index_, (offset, length) in enumerate(zip(self.offsets, self.length1)):
+                if index_ in self._replaced:
+                    digests.append(crc32(self._replaced[index_].data))
+                else:
+                    digests.append(crc32(buf[offset:offset+length]))
+            for index_ in range(len(self.offsets), len(self)):
+                digests.append(crc32(self._replaced[index_].data))
+            self._digests = digests
+        return (self.changeflags[index], self.types[index], self.versions[index],
+                self.length2[index], self._digests[index])
+
+    def find(self, formid):
+        try:
+            return self[self.index(formid)]
+        except KeyError:
+            return None
+
+    def positions_of_type(self, type):
+        if self._by_type is None:
+            self._build_indexes()
+        return self._by_type.get(type, array('I'))
+
+    def positions_with_flags(self, mask):
+        """Positions of the change forms that have every bit of mask set."""
+        if self._by_flag is None:
+            self._build_indexes()
+        result = None
+        while mask:
+            bit = mask & -mask
+            positions = self._by_flag.get(bit, ())
+            result = set(positions) if result is None else result.intersection(positions)
+            mask ^= bit
+        if result is None:
+            return array('I', range(len(self)))
+        return array('I', sorted(result))
+
+    def of_type(self, type):
+        for index in self.positions_of_type(type):
+            yield self[index]
+
+    def with_flags(self, mask):
+        for index in self.positions_with_flags(mask):
+            yield self[index]
+
+
 def parse_header(filehandle):
     magic = filehandle.read(13)
-    size, = unpack('I', filehandle.read(4))
-    version, saveNumber = unpack('II', filehandle.read(8))
-    playerName = parse_wstring(filehandle)
-    playerLevel, = unpack('I', filehandle.read(4))
-    playerLocation = parse_wstring(filehandle)
-    gameDate = parse_wstring(filehandle)
-    playerRaceEditorId = parse_wstring(filehandle)
-    unknown, = unpack('H', filehandle.read(2))
-    unknowns = unpack('ff', filehandle.read(8))
+    size, version, saveNumber = filehandle.unpack('III')
+    playerName = filehandle.wstring()
+    playerLevel = filehandle.u32()
+    playerLocation = filehandle.wstring()
+    gameDate = filehandle.wstring()
+    playerRaceEditorId = filehandle.wstring()
+    unknown = filehandle.u16()
+    unknowns = filehandle.unpack('ff')
     res = [magic, size, version, saveNumber, playerName, playerLevel, playerLocation, gameDate, playerRaceEditorId]
     res.append(unknown)
     res.extend(list(unknowns))
@@ -718,10 +1513,10 @@ def parse_header(filehandle):
     return res
 
 def parse_file_location_table(filehandle):
-    return FileLocationTable._make(list(unpack('25I', filehandle.read(25*4))))
+    return FileLocationTable._make(filehandle.unpack('25I'))
 
 def parse_global_data_item(filehandle, version):
-    type, size = unpack('II', filehandle.read(8))
+    type, size = filehandle.unpack('II')
     #data = filehandle.read(size)
     if version < 9:
         parsers = GlobalDataTypeParsers_pre9
@@ -738,135 +1533,763 @@ def parse_global_data_item(filehandle, version):
     return name, (size, type, parser(filehandle, size, name))
 
 
-def write_global_data_item(filehandle, name, item):
+def encode_global_data_item(item, version):
+    """The type/size header and payload of a global data item, with the
+    size taken from the encoded payload rather than the stored one."""
     size, type, data = item
-    filehandle.write(pack('I', type))
-    filehandle.write(pack('I', size))
-    name, _, writer = GlobalDataTypeParsers[type]
-    return writer(filehandle, data)
+    if version < 9:
+        parsers = GlobalDataTypeParsers_pre9
+    else:
+        parsers = GlobalDataTypeParsers
+
+    writer = parsers.get(type, (None, None, write_dummy))[2]
+    if writer is write_dummy:
+        payload = data
+    else:
+        w = Writer()
+        writer(w, data)
+        payload = w.getvalue()
+    return pack('II', type, len(payload)), payload
+
+
+def write_global_data_item(filehandle, name, item, version=9):
+    for buf in encode_global_data_item(item, version):
+        filehandle.write(buf)
+    return True
 
 
 def get_header(filename, imagename=None):
-    with open(filename, 'rb') as essfile:
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # mmap refuses empty files; fail like any other short header.
+            raise error('Empty file: %s' % filename)
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with m:
+        essfile = Reader(m)
         headerpart = parse_header(essfile)
         screenshot = parse_screenshot(essfile, imagename)
-        formVersion, = unpack('B', essfile.read(1))
+        formVersion = essfile.u8()
         headerpart.extend([screenshot, formVersion])
 
         # Plugins
         plugins = list()
-        pluginInfoSize, plugincount = unpack('IB', essfile.read(5))
+        pluginInfoSize, plugincount = essfile.unpack('IB')
         headerpart.extend([pluginInfoSize, plugincount])
         header = SaveGameHeader._make(headerpart)
         return header
 
-def load(filename, imagename=None):
-    print("Opening '{0}'".format(filename))
-    with open(filename, 'rb') as essfile:
-        headerpart = parse_header(essfile)
-        print(headerpart)
-        screenshot = parse_screenshot(essfile, imagename)
-        formVersion, = unpack('B', essfile.read(1))
-        headerpart.extend([screenshot, formVersion])
+HEADER_PREFETCH = 4096
 
-        # Plugins
-        plugins = list()
-        pluginInfoSize, plugincount = unpack('IB', essfile.read(5))
-        headerpart.extend([pluginInfoSize, plugincount])
-        header = SaveGameHeader._make(headerpart)
+def read_header(filename):
+    """The SaveGameHeader of filename without reading the screenshot.
 
+    Only the bytes up to the screenshot and the few after it are read; the
+    screenshot field is (width, height, None).
+    """
+    with open(filename, 'rb') as essfile:
+        prefetch = HEADER_PREFETCH
+        while True:
+            essfile.seek(0)
+            buf = essfile.read(prefetch)
+            try:
+                data = Reader(buf)
+                headerpart = parse_header(data)
+                width, height = data.unpack('II')
+                break
+            except (error, IndexError):
+                if len(buf) < prefetch:
+                    raise
+                prefetch *= 4
+        essfile.seek(data.tell() + 3*width*height)
+        formVersion, pluginInfoSize, plugincount = Reader(essfile.read(6)).unpack('BIB')
+    headerpart.extend([(width, height, None), formVersion, pluginInfoSize, plugincount])
+    return SaveGameHeader._make(headerpart)
+
+def _load_header_cache(cache_file):
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return dict()
+
+def _save_header_cache(cache_file, cache):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp = '%s.%d' % (cache_file, os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, cache_file)
+
+def scan_headers(path, cache_file=None, workers=None):
+    """Headers of all .ess files in path as a sorted list of (filename, header).
+
+    Files are read in a thread pool with read_header. Results are kept in a
+    pickle cache (by default in ~/.cache/essedit) keyed by absolute path,
+    size and mtime, so rescanning an unchanged directory does not open
+    any save.
+    """
+    if cache_file is None:
+        # Renamed when the pickled header format changes: 2 keeps FileTime.ticks.
+        cache_file = os.path.join(default_cache_dir(), 'headers2.pickle')
+    cache = _load_header_cache(cache_file)
+
+    filenames = sorted(os.path.join(path, name) for name in os.listdir(path)
+                       if name.lower().endswith('.ess'))
+    result = dict()
+    missing = list()
+    for filename in filenames:
+        st = os.stat(filename)
+        key = os.path.abspath(filename)
+        stamp = (st.st_size, st.st_mtime_ns)
+        cached = cache.get(key)
+        if cached and cached[0] == stamp:
+            if cached[1] is not None:
+                result[filename] = SaveGameHeader._make(cached[1])
+        else:
+            missing.append((filename, key, stamp))
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            headers = pool.map(_try_read_header, [filename for filename, key, stamp in missing])
+            for (filename, key, stamp), header in zip(missing, headers):
+                # Unreadable files are cached too, so they are not retried
+                # until they change.
+                if header is None:
+                    cache[key] = (stamp, None)
+                else:
+                    result[filename] = header
+                    cache[key] = (stamp, tuple(header))
+        _save_header_cache(cache_file, cache)
+
+    return [(filename, result[filename]) for filename in filenames if filename in result]
+
+def _try_read_header(filename):
+    try:
+        return read_header(filename)
+    except (IOError, OSError, error, IndexError) as e:
+        log.warning("Can't read header of %s: %s", filename, e)
+        return None
+
+
+class LazySaveGame(object):
+    """A save game backed by a read-only mmap of the .ess file.
+
+    Only the header, the plugin list and the FileLocationTable are read up
+    front. Every other section is parsed from its FileLocationTable offset
+    the first time its attribute is accessed, so tools that only need e.g.
+    the Misc Stats or the formID array never touch the change forms.
+    Attribute names and contents match the SaveGame tuple returned by load().
+    """
+
+    def __init__(self, filename, imagename=None):
+        self.filename = filename
+        with open(filename, 'rb') as essfile:
+            self._map = mmap.mmap(essfile.fileno(), 0, access=mmap.ACCESS_READ)
+        self._reader = data = Reader(self._map)
+
+        self._headerpart = parse_header(data)
+        self._screenshot_offset = data.tell()
+        width, height = data.unpack('II')
+        data.skip(3*width*height)
+        formVersion, pluginInfoSize, plugincount = data.unpack('BIB')
+        self._headerpart.extend([formVersion, pluginInfoSize, plugincount])
+        self.version = self._headerpart[2]
+        # The header without the screenshot pixels, as read_header() returns it.
+        headerpart = list(self._headerpart)
+        headerpart.insert(-3, (width, height, None))
+        self.header = SaveGameHeader._make(headerpart)
+
+        self.plugins = list()
         for index in range(plugincount):
-            plugins.append(parse_wstring(essfile))
-
-        flt = parse_file_location_table(essfile)
-        print(flt)
-        g1 = OrderedDict()
-        for c in range(flt.globalDataTable1Count):
-            key, item = parse_global_data_item(essfile, header.version)
-            g1[key] = item
-        g2 = OrderedDict()
-        for c in range(flt.globalDataTable2Count):
-            key, item = parse_global_data_item(essfile, header.version)
-            g2[key] = item
-
-        changeforms = list()
-        for c in range(flt.changeFormCount):
-            r = parse_record(essfile)
-            changeforms.append(r)
-
-        g3 = OrderedDict()
-        for c in range(flt.globalDataTable3Count+1): # +1 bugfix
-            key, item = parse_global_data_item(essfile, header.version)
-            g3[key] = item
-
-        # formIds
-        formIDArrayCount, = unpack('I', essfile.read(4))
-        formIDArray = unpack('%sI' % formIDArrayCount, essfile.read(4 * formIDArrayCount))
-
-        # unknown
-        unknownCount, = unpack('I', essfile.read(4))
-        unknownArray = unpack('%sI' % unknownCount, essfile.read(4 * unknownCount))
-
-        # unknown
+            self.plugins.append(parse_wstring(data))
+
+        self._flt_offset = data.tell()
+        self.filelocations = parse_file_location_table(data)
+        self._global_items = dict()
+
+        if imagename:
+            self._load_gameheader(imagename)
+
+    # Section attribute -> loader method. A loader may set several
+    # attributes when they are stored back to back in the file.
+    _section_loaders = {'gameheader': '_load_gameheader',
+                        'g1': '_load_g1',
+                        'g2': '_load_g2',
+                        'changeforms': '_load_changeforms',
+                        'g3': '_load_g3',
+                        'formIDArray': '_load_formid_array',
+                        'visitedWorldspaceArrayCount': '_load_formid_array',
+                        'visitedWorldspaceArray': '_load_unknown_table3',
+                        'unknownBytes': '_load_unknown_table3'}
+
+    def __getattr__(self, name):
+        # Only called when the attribute has not been loaded yet.
+        try:
+            loader = self._section_loaders[name]
+        except KeyError:
+            raise AttributeError(name)
+        getattr(self, loader)()
+        return self.__dict__[name]
+
+    def _seek(self, offset):
+        self._reader.seek(offset)
+        return self._reader
+
+    def _load_gameheader(self, imagename=None):
+        data = self._seek(self._screenshot_offset)
+        screenshot = parse_screenshot(data, imagename)
+        headerpart = list(self._headerpart)
+        headerpart.insert(-3, screenshot)
+        self.gameheader = SaveGameHeader._make(headerpart)
+        self._screenshot = screenshot
+
+    def _load_global_data(self, name, offset, count):
+        # Remembers where each item came from for write_patched().
+        data = self._seek(offset)
+        result = OrderedDict()
+        sources = dict()
+        for c in range(count):
+            start = data.tell()
+            key, item = parse_global_data_item(data, self.version)
+            result[key] = item
+            sources[key] = (item, start, data.tell())
+        self._global_items[name] = sources
+        setattr(self, name, result)
+
+    def _load_g1(self):
+        flt = self.filelocations
+        self._load_global_data('g1', flt.globalDataTable1Offset,
+                               flt.globalDataTable1Count)
+
+    def _load_g2(self):
+        flt = self.filelocations
+        self._load_global_data('g2', flt.globalDataTable2Offset,
+                               flt.globalDataTable2Count)
+
+    def _load_g3(self):
+        flt = self.filelocations
+        self._load_global_data('g3', flt.globalDataTable3Offset,
+                                 flt.globalDataTable3Count+1) # +1 bugfix
+
+    def _load_changeforms(self):
+        self.changeforms = ChangeFormTable(self._map, self.filelocations.changeFormsOffset,
+                                           self.filelocations.changeFormCount)
+
+    def _load_formid_array(self):
+        data = self._seek(self.filelocations.formIDArrayOffset)
+        formIDArrayCount = data.u32()
+        self.formIDArray = parse_uint32_array(self._map, formIDArrayCount, data.tell())
+        data.skip(4 * formIDArrayCount)
+        unknownCount = data.u32()
+        self.visitedWorldspaceArrayCount = parse_uint32_array(self._map, unknownCount, data.tell())
+
+    def _load_unknown_table3(self):
+        data = self._seek(self.filelocations.unknownTable3Offset)
+        self.unknownBytes, unknownCount = data.unpack('II')
         unknowntable3 = list()
-        unknownBytes, = unpack('I', essfile.read(4))
-        unknownCount, = unpack('I', essfile.read(4))
-        for c in range(unknownCount): # +1 bugfix
-            unknowntable3.append(parse_wstring(essfile))
+        for c in range(unknownCount):
+            unknowntable3.append(data.wstring())
+        self.visitedWorldspaceArray = unknowntable3
+
+    def loaded(self, name):
+        return name in self.__dict__
+
+    def global_data_item(self, table, type):
+        """The (size, type, data) item of the given type from global data
+        table 'g1', 'g2' or 'g3'. Unless the table is already loaded, the
+        other items are skipped over, not parsed."""
+        if self.loaded(table):
+            for item in getattr(self, table).values():
+                if item[1] == type:
+                    return item
+            return None
+
+        flt = self.filelocations
+        offset, count = {'g1': (flt.globalDataTable1Offset, flt.globalDataTable1Count),
+                         'g2': (flt.globalDataTable2Offset, flt.globalDataTable2Count),
+                         'g3': (flt.globalDataTable3Offset, flt.globalDataTable3Count+1)}[table] # +1 bugfix
+        data = self._seek(offset)
+        for c in range(count):
+            item_type, size = data.unpack('II')
+            if item_type == type:
+                data.skip(-8)
+                return parse_global_data_item(data, self.version)[1]
+            data.skip(size)
+        return None
+
+    def section_ranges(self):
+        """Source byte range of each section, in file order."""
+        flt = self.filelocations
+        width, height = Reader(self._map, self._screenshot_offset).unpack('II')
+        pixels = self._screenshot_offset + 8
+        boundaries = [('gameheader', 0),
+                      ('screenshot', pixels),
+                      ('plugins', pixels + 3*width*height),
+                      ('filelocations', self._flt_offset),
+                      ('g1', flt.globalDataTable1Offset),
+                      ('g2', flt.globalDataTable2Offset),
+                      ('changeforms', flt.changeFormsOffset),
+                      ('g3', flt.globalDataTable3Offset),
+                      ('formIDArray', flt.formIDArrayOffset),
+                      ('unknownTable3', flt.unknownTable3Offset),
+                      (None, len(self._map))]
+        return OrderedDict((name, (start, end)) for (name, start), (_, end)
+                           in zip(boundaries, boundaries[1:]))
+
+    def savegame(self):
+        """Parse every remaining section and return a plain SaveGame."""
+        return SaveGame._make([getattr(self, field) for field in SaveGame._fields])
+
+    def close(self):
+        # These hold views into the mapping.
+        for name in ('changeforms', 'formIDArray', 'visitedWorldspaceArrayCount', '_reader'):
+            self.__dict__.pop(name, None)
+        try:
+            self._map.close()
+        except BufferError:
+            # Records handed out still reference the mapping; it is
+            # unmapped when the last of them is released.
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+CHANGEFORM_CHUNK_SIZE = 1 << 20
+
+def iter_changeforms(filename, types=None, min_size=None, chunk_size=CHANGEFORM_CHUNK_SIZE):
+    """Yield the change forms of filename one at a time, in constant memory.
+
+    The section is read in chunks of chunk_size bytes; each Record's data
+    is a memoryview into the current chunk. types (form type ids or
+    names) and min_size (of the uncompressed data) are checked on the
+    raw header bytes, and the bodies of skipped records are not read.
+    """
+    with LazySaveGame(filename) as savegame:
+        flt = savegame.filelocations
+    wanted = None
+    if types is not None:
+        type_ids = set(FormTypeIds[t] if isinstance(t, str) else t for t in types)
+        wanted = bytes(savegameform_to_form.get(code) in type_ids for code in range(64))
+
+    max_header = ChangeFormHeader.size + ChangeFormLengths[2].size
+    with open(filename, 'rb') as essfile:
+        essfile.seek(flt.changeFormsOffset)
+        buf = b''
+        pos = 0
+        for c in range(flt.changeFormCount):
+            if len(buf) - pos < max_header:
+                buf = buf[pos:] + essfile.read(max(chunk_size, max_header))
+                pos = 0
+            byte0, byte1, byte2, flags, rt, version = ChangeFormHeader.unpack_from(buf, pos)
+            lengths = ChangeFormLengths.get(rt >> 6)
+            if lengths is None:
+                raise Exception("Strange datasize: %r" % (rt >> 6))
+            length1, length2 = lengths.unpack_from(buf, pos + ChangeFormHeader.size)
+            start = pos + ChangeFormHeader.size + lengths.size
+            end = start + length1
+
+            if ((wanted is not None and not wanted[rt & 63]) or
+                (min_size is not None and (length2 or length1) < min_size)):
+                if end > len(buf):
+                    essfile.seek(end - len(buf), os.SEEK_CUR)
+                    buf = b''
+                    pos = 0
+                else:
+                    pos = end
+                continue
+
+            if end > len(buf):
+                buf = buf[pos:]
+                buf += essfile.read(max(chunk_size, end - pos - len(buf)))
+                start -= pos
+                end -= pos
+            yield Record((byte0 >> 6, ((byte0 & 63) << 16) | (byte1 << 8) | byte2),
+                         flags, savegameform_to_form[rt & 63], version, length1, length2,
+                         memoryview(buf)[start:end])
+            pos = end
+
+
+def load(filename, imagename=None, lazy=False):
+    if lazy:
+        return LazySaveGame(filename, imagename)
 
+    print("Opening '{0}'".format(filename))
+    with open(filename, 'rb') as essfile:
+        buf = essfile.read()
+
+    essfile = Reader(buf)
+    headerpart = parse_header(essfile)
+    print(headerpart)
+    screenshot = parse_screenshot(essfile, imagename)
+    formVersion = essfile.u8()
+    headerpart.extend([screenshot, formVersion])
+
+    # Plugins
+    plugins = list()
+    pluginInfoSize, plugincount = essfile.unpack('IB')
+    headerpart.extend([pluginInfoSize, plugincount])
+    header = SaveGameHeader._make(headerpart)
+
+    for index in range(plugincount):
+        plugins.append(essfile.wstring())
+
+    flt = parse_file_location_table(essfile)
+    print(flt)
+    g1 = OrderedDict()
+    for c in range(flt.globalDataTable1Count):
+        key, item = parse_global_data_item(essfile, header.version)
+        g1[key] = item
+    g2 = OrderedDict()
+    for c in range(flt.globalDataTable2Count):
+        key, item = parse_global_data_item(essfile, header.version)
+        g2[key] = item
+
+    changeforms = ChangeFormTable(buf, essfile.tell(), flt.changeFormCount)
+    essfile.seek(changeforms.end)
+
+    g3 = OrderedDict()
+    for c in range(flt.globalDataTable3Count+1): # +1 bugfix
+        key, item = parse_global_data_item(essfile, header.version)
+        g3[key] = item
+
+    # formIds
+    formIDArrayCount = essfile.u32()
+    formIDArray = parse_uint32_array(buf, formIDArrayCount, essfile.tell())
+    essfile.skip(4 * formIDArrayCount)
+
+    # unknown
+    unknownCount = essfile.u32()
+    unknownArray = parse_uint32_array(buf, unknownCount, essfile.tell())
+    essfile.skip(4 * unknownCount)
+
+    # unknown
+    unknowntable3 = list()
+    unknownBytes, unknownCount = essfile.unpack('II')
+    for c in range(unknownCount): # +1 bugfix
+        unknowntable3.append(essfile.wstring())
 
     savegame = SaveGame._make([header, flt, plugins, g1, g2, changeforms, g3, formIDArray, unknownArray, unknowntable3, unknownBytes])
     return savegame
 
-def write(savegame, filename):
-    with open(filename, 'wb') as essfile:
-        # Gameheader
-        essfile.write(savegame.gameheader.magic)
-        essfile.write(pack('III', savegame.gameheader.headerSize,
-                           savegame.gameheader.version, savegame.gameheader.saveNumber))
-        write_wstring(essfile, savegame.gameheader.playerName)
-        essfile.write(pack('I', savegame.gameheader.playerLevel))
-        write_wstring(essfile, savegame.gameheader.playerLocation)
-        write_wstring(essfile, savegame.gameheader.gameDate)
-        write_wstring(essfile, savegame.gameheader.playerRaceEditorId)
-        essfile.write(pack('H', savegame.gameheader.unknown1))
-        essfile.write(pack('ff', savegame.gameheader.unknown2, savegame.gameheader.unknown3))
-        write_filetime(essfile, savegame.gameheader.filetime)
-
-        im = savegame.gameheader.screenshot
-        w, h = im.size
-        essfile.write(pack('II', w, h))
-        essfile.write(im.tostring())
-        essfile.write(pack('B', savegame.gameheader.formVersion))
-
-        # Plugins
-        essfile.write(pack('IB', savegame.gameheader.pluginInfoSize, len(savegame.plugins)))
-        for plugin in savegame.plugins:
-            write_wstring(essfile, plugin)
-
-        essfile.write(pack('25I', *(list(savegame.filelocations._asdict().values()))))
-
-        for key, item in list(savegame.g1.items()):
-            write_global_data_item(essfile, key, item)
+def encode_header(header):
+    """Everything before the screenshot pixels, with headerSize recomputed."""
+    body = Writer()
+    body.pack('II', header.version, header.saveNumber)
+    body.wstring(header.playerName)
+    body.u32(header.playerLevel)
+    body.wstring(header.playerLocation)
+    body.wstring(header.gameDate)
+    body.wstring(header.playerRaceEditorId)
+    body.u16(header.playerSex)
+    body.pack('ff', header.playerCurExp, header.playerLvlUpExp)
+    write_filetime(body, header.filetime)
+    width, height, rgb_data = header.screenshot
+    body.pack('II', width, height)
+
+    w = Writer()
+    w.write(header.magic)
+    w.u32(len(body.getvalue()))
+    w.write(body.getvalue())
+    return w.getvalue()
+
+
+def serialize(savegame):
+    """Encode savegame as a list of buffers that concatenate to the file.
+
+    Every section is encoded (or, for untouched raw data such as unparsed
+    global data and a ChangeFormTable, referenced without copying) before
+    anything is written, so the FileLocationTable offsets and counts can be
+    filled in from the actual section sizes.
+    """
+    header = savegame.gameheader
+    buffers = list()
+    offsets = dict()
+    position = [0]
+
+    def add(buf):
+        buffers.append(buf)
+        position[0] += len(buf)
+
+    def add_global_data(name, items):
+        offsets[name] = position[0]
+        for item in items.values():
+            for buf in encode_global_data_item(item, header.version):
+                add(buf)
+
+    add(encode_header(header))
+    add(header.screenshot[2])
+
+    plugins = Writer()
+    plugins.u8(len(savegame.plugins))
+    for plugin in savegame.plugins:
+        plugins.wstring(plugin)
+    w = Writer()
+    w.u8(header.formVersion)
+    w.u32(len(plugins.getvalue()))
+    w.write(plugins.getvalue())
+    add(w.getvalue())
+
+    flt_index = len(buffers)
+    add(bytes(FileLocationTable_size))
+
+    add_global_data('globalDataTable1Offset', savegame.g1)
+    add_global_data('globalDataTable2Offset', savegame.g2)
+
+    offsets['changeFormsOffset'] = position[0]
+    if isinstance(savegame.changeforms, ChangeFormTable):
+        for buf in savegame.changeforms.buffers():
+            add(buf)
+    else:
+        w = Writer()
+        for record in savegame.changeforms:
+            write_record(w, record)
+        add(w.getvalue())
+
+    add_global_data('globalDataTable3Offset', savegame.g3)
+
+    offsets['formIDArrayOffset'] = position[0]
+    w = Writer()
+    write_uint32_array(w, savegame.formIDArray)
+    write_uint32_array(w, savegame.visitedWorldspaceArrayCount)
+    add(w.getvalue())
+
+    offsets['unknownTable3Offset'] = position[0]
+    w = Writer()
+    w.pack('II', savegame.unknownBytes, len(savegame.visitedWorldspaceArray))
+    for entry in savegame.visitedWorldspaceArray:
+        w.wstring(entry)
+    add(w.getvalue())
+
+    flt = savegame.filelocations._replace(globalDataTable1Count=len(savegame.g1),
+                                          globalDataTable2Count=len(savegame.g2),
+                                          globalDataTable3Count=len(savegame.g3)-1, # +1 bugfix
+                                          changeFormCount=len(savegame.changeforms),
+                                          **offsets)
+    buffers[flt_index] = pack('25I', *flt)
+    return buffers
+
+
+def write_buffers(essfile, buffers):
+    """Write buffers to essfile, with as few writev calls as possible."""
+    pending = [memoryview(buf).cast('B') for buf in buffers if len(buf)]
+    if not hasattr(os, 'writev'):
+        for buf in pending:
+            essfile.write(buf)
+        essfile.flush()
+        return
+
+    essfile.flush()
+    fd = essfile.fileno()
+    try:
+        iov_max = os.sysconf('SC_IOV_MAX')
+    except (ValueError, OSError):
+        iov_max = 1024
+    while pending:
+        written = os.writev(fd, pending[:iov_max])
+        while written:
+            if written >= len(pending[0]):
+                written -= len(pending.pop(0))
+            else:
+                pending[0] = pending[0][written:]
+                written = 0
 
-        for key, item in list(savegame.g2.items()):
-            write_global_data_item(essfile, key, item)
 
-        for record in savegame.changeforms:
-            write_record(essfile, record)
+def write(savegame, filename):
+    buffers = serialize(savegame)
+    with open(filename, 'wb') as essfile:
+        write_buffers(essfile, buffers)
+
+
+def patch_pieces(savegame):
+    """The file for a LazySaveGame as a list of pieces: (start, end) ranges
+    to copy from the source file, and bytes to write.
+
+    Sections that were never loaded are copied whole. Loaded sections are
+    re-encoded piecewise and the source range is used wherever the
+    encoding is unchanged, so only modified parts end up as new bytes.
+    """
+    ranges = savegame.section_ranges()
+    source = savegame._map
+    version = savegame.version
+    pieces = list()
+    offsets = dict()
+    position = [0]
+
+    def add(piece):
+        if isinstance(piece, tuple):
+            if piece[0] == piece[1]:
+                return
+            if pieces and isinstance(pieces[-1], tuple) and pieces[-1][1] == piece[0]:
+                pieces[-1] = (pieces[-1][0], piece[1])
+            else:
+                pieces.append(piece)
+            position[0] += piece[1] - piece[0]
+        else:
+            pieces.append(piece)
+            position[0] += len(piece)
 
-        for key, item in list(savegame.g3.items()):
-            write_global_data_item(essfile, key, item)
+    def add_encoded(buf, start, end):
+        if source[start:end] == buf:
+            add((start, end))
+        else:
+            add(bytes(buf))
+
+    def add_global_data(name):
+        if not savegame.loaded(name):
+            add(ranges[name])
+            return
+        sources = savegame._global_items[name]
+        for key, item in getattr(savegame, name).items():
+            original = sources.get(key)
+            if original and original[0] is item and isinstance(item[2], (bytes, memoryview)):
+                add(original[1:])
+                continue
+            buf = b''.join(encode_global_data_item(item, version))
+            if original:
+                add_encoded(buf, original[1], original[2])
+            else:
+                add(buf)
+
+    if savegame.loaded('gameheader'):
+        header = savegame.gameheader
+        add_encoded(encode_header(header), *ranges['gameheader'])
+        if header.screenshot is savegame._screenshot:
+            add(ranges['screenshot'])
+        else:
+            add(header.screenshot[2])
+        formVersion = header.formVersion
+    else:
+        add(ranges['gameheader'])
+        add(ranges['screenshot'])
+        formVersion = savegame._headerpart[-3]
+
+    plugins = Writer()
+    plugins.u8(len(savegame.plugins))
+    for plugin in savegame.plugins:
+        plugins.wstring(plugin)
+    w = Writer()
+    w.u8(formVersion)
+    w.u32(len(plugins.getvalue()))
+    w.write(plugins.getvalue())
+    add_encoded(w.getvalue(), *ranges['plugins'])
+
+    flt_index = len(pieces)
+    add(bytes(FileLocationTable_size))
+
+    offsets['globalDataTable1Offset'] = position[0]
+    add_global_data('g1')
+    offsets['globalDataTable2Offset'] = position[0]
+    add_global_data('g2')
+
+    offsets['changeFormsOffset'] = position[0]
+    if savegame.loaded('changeforms'):
+        for span in savegame.changeforms.spans():
+            add(span)
+    else:
+        add(ranges['changeforms'])
 
-        essfile.write(pack('I', len(savegame.formIDArray)))
-        essfile.write(pack('%sI' % len(savegame.formIDArray), *(savegame.formIDArray)))
-        essfile.write(pack('I', len(savegame.unknown2)))
-        essfile.write(pack('%sI' % len(savegame.unknown2), *(savegame.unknown2)))
+    offsets['globalDataTable3Offset'] = position[0]
+    add_global_data('g3')
 
-        essfile.write(pack('I', savegame.unknownBytes))
-        essfile.write(pack('I', len(savegame.unknown3)))
-        for entry in savegame.unknown3:
-            write_wstring(essfile, entry)
+    offsets['formIDArrayOffset'] = position[0]
+    if savegame.loaded('formIDArray') or savegame.loaded('visitedWorldspaceArrayCount'):
+        w = Writer()
+        write_uint32_array(w, savegame.formIDArray)
+        write_uint32_array(w, savegame.visitedWorldspaceArrayCount)
+        add_encoded(w.getvalue(), *ranges['formIDArray'])
+    else:
+        add(ranges['formIDArray'])
+
+    offsets['unknownTable3Offset'] = position[0]
+    if savegame.loaded('unknownBytes') or savegame.loaded('visitedWorldspaceArray'):
+        w = Writer()
+        w.pack('II', savegame.unknownBytes, len(savegame.visitedWorldspaceArray))
+        for entry in savegame.visitedWorldspaceArray:
+            w.wstring(entry)
+        add_encoded(w.getvalue(), *ranges['unknownTable3'])
+    else:
+        add(ranges['unknownTable3'])
+
+    counts = dict()
+    if savegame.loaded('g1'):
+        counts['globalDataTable1Count'] = len(savegame.g1)
+    if savegame.loaded('g2'):
+        counts['globalDataTable2Count'] = len(savegame.g2)
+    if savegame.loaded('g3'):
+        counts['globalDataTable3Count'] = len(savegame.g3) - 1 # +1 bugfix
+    if savegame.loaded('changeforms'):
+        counts['changeFormCount'] = len(savegame.changeforms)
+    new_flt = pack('25I', *savegame.filelocations._replace(**dict(offsets, **counts)))
+    flt_range = ranges['filelocations']
+    pieces[flt_index] = (flt_range if source[flt_range[0]:flt_range[1]] == new_flt
+                         else new_flt)
+
+    merged = list()
+    for piece in pieces:
+        if (merged and isinstance(piece, tuple) and isinstance(merged[-1], tuple) and
+            merged[-1][1] == piece[0]):
+            merged[-1] = (merged[-1][0], piece[1])
+        else:
+            merged.append(piece)
+    return merged
+
+
+def copy_range(src_fd, dst_fd, start, end):
+    """Copy [start, end) of src_fd to the current position of dst_fd, inside
+    the kernel where the platform and file systems allow it."""
+    methods = [_copy_file_range, _sendfile, _read_write]
+    while start < end:
+        try:
+            n = methods[0](src_fd, dst_fd, start, end - start)
+        except (OSError, AttributeError):
+            # Not supported for this pair of files; fall back to the next method.
+            if len(methods) == 1:
+                raise
+            methods.pop(0)
+            continue
+        if n == 0:
+            raise IOError("Unexpected end of source file at %d" % start)
+        start += n
+
+def _copy_file_range(src_fd, dst_fd, start, count):
+    return os.copy_file_range(src_fd, dst_fd, count, start)
+
+def _sendfile(src_fd, dst_fd, start, count):
+    return os.sendfile(dst_fd, src_fd, start, count)
+
+def _read_write(src_fd, dst_fd, start, count):
+    data = os.pread(src_fd, min(count, 1 << 20), start)
+    view = memoryview(data)
+    while view:
+        view = view[os.write(dst_fd, view):]
+    return len(data)
+
+
+def write_patched(savegame, filename):
+    """Write a LazySaveGame to filename, copying every untouched byte range
+    straight from the source file and encoding only what changed."""
+    if os.path.exists(filename) and os.path.samefile(filename, savegame.filename):
+        raise ValueError("Can't patch %s onto itself" % filename)
+
+    pieces = patch_pieces(savegame)
+    with open(savegame.filename, 'rb') as src, open(filename, 'wb') as essfile:
+        pending = list()
+        for piece in pieces:
+            if isinstance(piece, tuple):
+                write_buffers(essfile, pending)
+                pending = list()
+                copy_range(src.fileno(), essfile.fileno(), *piece)
+            else:
+                pending.append(piece)
+        write_buffers(essfile, pending)
+
+def differs(x, y):
+    if numpy is not None and isinstance(x, numpy.ndarray):
+        return not numpy.array_equal(x, y)
+    return x != y
 
 def diff_dict(d1, d2):
     commonkeys = set(d1.keys())
@@ -874,7 +2297,7 @@ def diff_dict(d1, d2):
     d1only = set(d1).difference(set(d2))
     d2only = set(d2).difference(set(d1))
     for key in commonkeys:
-        if d1[key] != d2[key]:
+        if differs(d1[key], d2[key]):
             print(('%r' %  (key,)))
             diff_item(d1[key], d2[key])
 
@@ -891,7 +2314,7 @@ def dictify_namedtuple(d):
 
 def diff_namedtuple(t1, t2):
     for x, y, field in zip(t1, t2, t1._fields):
-        if x != y:
+        if differs(x, y):
             print(field)
             diff_item(x, y)
             print()
@@ -904,30 +2327,495 @@ def diff_item(x, y):
             diff_sequence(x, y)
     elif isinstance(x, dict):
         diff_dict(x, y)
+    elif isinstance(x, ChangeFormTable):
+        print_changeform_diff(diff_changeforms(x, y))
     elif isinstance(x, list):
         diff_sequence(x, y)
-    elif isinstance(x, str):
+    elif isinstance(x, (str, bytes, memoryview)):
         diff_string(x, y)
     else:
         print(("%r != %r" % (x, y)))
 
+def common_prefix(s1, s2):
+    """Length of the common prefix of two sliceable sequences.
+
+    Works with galloping slice comparisons, so the bytes are compared by
+    memcmp instead of one at a time in Python.
+    """
+    n = min(len(s1), len(s2))
+    lo, step = 0, 64
+    while lo < n:
+        hi = min(lo + step, n)
+        if s1[lo:hi] != s2[lo:hi]:
+            break
+        lo = hi
+        step *= 2
+    else:
+        return n
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if s1[lo:mid] == s2[lo:mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+def common_suffix(s1, s2, limit):
+    """Length of the common suffix of s1 and s2, at most limit."""
+    n1, n2 = len(s1), len(s2)
+    lo, step = 0, 64
+    while lo < limit:
+        hi = min(lo + step, limit)
+        if s1[n1-hi:n1-lo] != s2[n2-hi:n2-lo]:
+            break
+        lo = hi
+        step *= 2
+    else:
+        return limit
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if s1[n1-mid:n1-lo] == s2[n2-mid:n2-lo]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+def _differing_runs(s1, s2, lo, hi, runs):
+    if s1[lo:hi] == s2[lo:hi]:
+        return
+    if hi - lo > 32:
+        mid = (lo + hi) // 2
+        _differing_runs(s1, s2, lo, mid, runs)
+        _differing_runs(s1, s2, mid, hi, runs)
+        return
+    for i in range(lo, hi):
+        if s1[i] != s2[i]:
+            if runs and runs[-1][1] == i:
+                runs[-1][1] = i + 1
+            else:
+                runs.append([i, i + 1])
+
+def diff_ranges(s1, s2):
+    """The differing ranges of two sequences as (i1, i2, j1, j2) tuples.
+
+    Runs in near-linear time: the common prefix and suffix are split off,
+    and equal-length middles are bisected down to the differing runs.
+    Inserted or removed data shows up as one range between prefix and
+    suffix.
+    """
+    prefix = common_prefix(s1, s2)
+    if prefix == len(s1) == len(s2):
+        return []
+    suffix = common_suffix(s1, s2, min(len(s1), len(s2)) - prefix)
+    end1, end2 = len(s1) - suffix, len(s2) - suffix
+    if len(s1) != len(s2):
+        return [(prefix, end1, prefix, end2)]
+    runs = list()
+    _differing_runs(s1, s2, prefix, end1, runs)
+    return [(i1, i2, i1, i2) for i1, i2 in runs]
+
 def diff_string(s1, s2):
     print(('len %s' % len(s1)))
-    if len(s1) > 1000000:
-        print('too long')
-    else:
-        s = SequenceMatcher(None, s1, s2)
-        for tag, i1, i2, j1, j2 in s.get_opcodes():
-            if tag != 'equal':
-                print(("%7s a[%d:%d] (%s) b[%d:%d] (%s)" %
-                       (tag, i1, i2, s1[i1:i2], j1, j2, s2[j1:j2])))
+    for i1, i2, j1, j2 in diff_ranges(s1, s2):
+        if i1 == i2:
+            tag = 'insert'
+        elif j1 == j2:
+            tag = 'delete'
+        else:
+            tag = 'replace'
+        print(("%7s a[%d:%d] (%r) b[%d:%d] (%r)" %
+               (tag, i1, i2, _preview(s1[i1:i2]), j1, j2, _preview(s2[j1:j2]))))
+
+def _preview(s, limit=64):
+    if isinstance(s, memoryview):
+        s = s.tobytes()
+    if len(s) <= limit:
+        return s
+    return s[:limit] + ('...' if isinstance(s, str) else b'...')
+
+
+ChangeFormDiff = namedtuple('ChangeFormDiff', 'added removed modified')
+
+def record_digest(record):
+    return (record.changeflags, record.type, record.version, record.length2,
+            zlib.crc32(record.data))
+
+def _formid_positions(changeforms):
+    if isinstance(changeforms, ChangeFormTable):
+        return changeforms.formid_positions(), changeforms.digest
+    positions = {(r.formid[0] << 22) | r.formid[1]: i for i, r in enumerate(changeforms)}
+    return positions, lambda index: record_digest(changeforms[index])
+
+def diff_changeforms(cf1, cf2):
+    """Compare two sets of change forms matched by formid.
+
+    Records present in both are compared by digest first; only the ones
+    whose digests differ are compared byte by byte. Returns a
+    ChangeFormDiff of the added and removed Records and a list of
+    (record1, record2, ranges) for the modified ones, with ranges as
+    returned by diff_ranges for the record data.
+    """
+    positions1, digest1 = _formid_positions(cf1)
+    positions2, digest2 = _formid_positions(cf2)
+
+    added = [cf2[i] for key, i in sorted(positions2.items(), key=lambda kv: kv[1])
+             if key not in positions1]
+    removed = [cf1[i] for key, i in sorted(positions1.items(), key=lambda kv: kv[1])
+               if key not in positions2]
+    modified = list()
+    for key, i1 in sorted(positions1.items(), key=lambda kv: kv[1]):
+        i2 = positions2.get(key)
+        if i2 is None or digest1(i1) == digest2(i2):
+            continue
+        r1, r2 = cf1[i1], cf2[i2]
+        if r1 != r2:
+            modified.append((r1, r2, diff_ranges(r1.data, r2.data)))
+    return ChangeFormDiff(added, removed, modified)
+
+def print_changeform_diff(diff):
+    for r in diff.added:
+        print("Only in second: %r %s" % (r.formid, FormTypes.get(r.type, ('?',))[0]))
+    for r in diff.removed:
+        print("Only in first: %r %s" % (r.formid, FormTypes.get(r.type, ('?',))[0]))
+    for r1, r2, ranges in diff.modified:
+        print("Changed: %r %s" % (r1.formid, FormTypes.get(r1.type, ('?',))[0]))
+        for field in ('changeflags', 'type', 'version', 'length1', 'length2'):
+            x, y = getattr(r1, field), getattr(r2, field)
+            if x != y:
+                print("  %s: %r != %r" % (field, x, y))
+        for i1, i2, j1, j2 in ranges:
+            print("  data a[%d:%d] (%r) b[%d:%d] (%r)" %
+                  (i1, i2, _preview(r1.data[i1:i2]), j1, j2, _preview(r2.data[j1:j2])))
+    print("%d added, %d removed, %d modified" %
+          (len(diff.added), len(diff.removed), len(diff.modified)))
 
 
 def diff_sequence(s1, s2):
     for i1, i2 in zip(s1, s2):
-        if i1 != i2:
+        if differs(i1, i2):
             diff_item(i1, i2)
 
+def load_form_strings(filename):
+    """(formids, string ids) from a text file with a formid and the string
+    id of its name on each line, e.g. '0x0001A332 0x000118F5'; the ids can
+    be hex or decimal. Plugins carry this mapping, saves do not."""
+    formids = array('I')
+    string_ids = array('I')
+    with open(filename) as f:
+        for line in f:
+            fields = line.split('#')[0].replace(',', ' ').split()
+            if len(fields) >= 2:
+                formids.append(int(fields[0], 0))
+                string_ids.append(int(fields[1], 0))
+    return formids, string_ids
+
+class NameResolver(object):
+    """Names of forms, looked up in a StringStore in batches.
+
+    form_strings is (formids, string ids) or a {formid: string id} dict.
+    Resolved names are kept in an LRU cache of cache_size entries, which
+    is shared by everything resolved through the same resolver, e.g. all
+    saves of a library.
+    """
+
+    def __init__(self, strings, form_strings, cache_size=65536):
+        self.strings = strings
+        if isinstance(form_strings, dict):
+            form_strings = (list(form_strings.keys()), list(form_strings.values()))
+        formids, string_ids = form_strings
+        order = sorted(range(len(formids)), key=formids.__getitem__)
+        self.formids = array('I', [formids[i] for i in order])
+        self.string_ids = array('I', [string_ids[i] for i in order])
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def _string_ids(self, formids):
+        if numpy is not None and len(self.formids):
+            known = numpy.frombuffer(self.formids, dtype=numpy.uint32)
+            wanted = numpy.asarray(formids, dtype=numpy.uint32)
+            positions = numpy.minimum(numpy.searchsorted(known, wanted), len(known) - 1)
+            found = known[positions] == wanted
+            string_ids = numpy.frombuffer(self.string_ids, dtype=numpy.uint32)[positions]
+            return numpy.where(found, string_ids, 0).tolist()
+        result = list()
+        for formid in formids:
+            i = bisect_left(self.formids, formid)
+            found = i < len(self.formids) and self.formids[i] == formid
+            result.append(self.string_ids[i] if found else 0)
+        return result
+
+    def resolve(self, formids):
+        """The name of each formid, or None."""
+        cache = self._cache
+        if numpy is not None:
+            unique, inverse = numpy.unique(numpy.asarray(formids, dtype=numpy.uint32),
+                                           return_inverse=True)
+            unique = unique.tolist()
+        else:
+            unique = sorted(set(formids))
+        names = dict()
+        missing = list()
+        for formid in unique:
+            if formid in cache:
+                cache.move_to_end(formid)
+                names[formid] = cache[formid]
+            else:
+                missing.append(formid)
+        if missing:
+            string_ids = self._string_ids(missing)
+            for formid, name in zip(missing, self.strings.lookup_strings(string_ids)):
+                names[formid] = name
+                cache[formid] = name
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        if numpy is not None:
+            return [names[formid] for formid in numpy.asarray(unique, dtype=object)[inverse].tolist()]
+        return [names[formid] for formid in formids]
+
+    def resolve_refids(self, savegame, flags, values):
+        return self.resolve(refids_to_formids(flags, values, savegame.formIDArray))
+
+    def resolve_changeforms(self, savegame, positions=None):
+        """Names of the change forms at positions, by default all of them."""
+        packed = savegame.changeforms.formids
+        if positions is not None:
+            packed = [packed[i] for i in positions]
+        if numpy is not None:
+            packed = numpy.asarray(packed, dtype=numpy.uint32)
+            return self.resolve_refids(savegame, packed >> 22, packed & 0x3fffff)
+        return self.resolve_refids(savegame, [f >> 22 for f in packed],
+                                   [f & 0x3fffff for f in packed])
+
+    def resolve_globals(self, savegame):
+        """{refid: (name, value)} for the Global Variables of savegame."""
+        item = savegame.global_data_item('g1', 3) if isinstance(savegame, LazySaveGame) else \
+            next((item for item in savegame.g1.values() if item[1] == 3), None)
+        if item is None:
+            return OrderedDict()
+        data = item[2]
+        if not isinstance(data, dict):
+            data = parse_globals(Reader(data), item[0], 'Global Variables')
+        flags, values = split_refids(list(data.keys()))
+        names = self.resolve_refids(savegame, flags, values)
+        return OrderedDict((refid, (name, value))
+                           for (refid, value), name in zip(data.items(), names))
+
+
+def load_sections(filename, sections=None):
+    """load(filename), or with sections a LazySaveGame with just those
+    sections (e.g. ('gameheader', 'changeforms')) loaded."""
+    if sections is None:
+        return load(filename)
+    savegame = LazySaveGame(filename)
+    try:
+        for name in sections:
+            getattr(savegame, name)
+    except Exception:
+        savegame.close()
+        raise
+    return savegame
+
+def _try_load_sections(filename, sections):
+    try:
+        return load_sections(filename, sections)
+    except Exception as e:
+        log.warning("Can't load %s: %s", filename, e)
+        return None
+
+async def load_many(paths, concurrency=4, sections=None, executor=None):
+    """Load saves in an executor and yield (path, savegame) as each one
+    finishes; savegame is None if it could not be loaded.
+
+    At most concurrency saves are in flight. sections is passed on to
+    load_sections. Closing the generator or cancelling the task that
+    iterates it cancels the loads that have not started yet; running
+    ones finish in the background and their results are dropped.
+    """
+    loop = asyncio.get_running_loop()
+    paths = iter(paths)
+    pending = dict()
+
+    def submit():
+        for path in paths:
+            future = loop.run_in_executor(executor, _try_load_sections, path, sections)
+            pending[future] = path
+            return True
+        return False
+
+    try:
+        while len(pending) < concurrency and submit():
+            pass
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                submit()
+                yield path, future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+ValidationResult = namedtuple('ValidationResult', 'filename size offset section seconds error')
+
+def section_at(filename, offset):
+    """Name of the section of filename that contains offset."""
+    with LazySaveGame(filename) as savegame:
+        for name, (start, end) in savegame.section_ranges().items():
+            if start <= offset < end:
+                return name
+    return 'end of file'
+
+def validate_file(filename):
+    """Load filename, serialize it again and compare with the original.
+
+    offset is the first differing byte and section the section it is in,
+    both None if the round trip is exact; error is set if the file could
+    not be loaded or written.
+    """
+    start = time.perf_counter()
+    size = os.path.getsize(filename)
+    try:
+        with open(filename, 'rb') as essfile:
+            original = essfile.read()
+        with contextlib.redirect_stdout(io.StringIO()):
+            written = b''.join(serialize(load(filename)))
+    except Exception as e:
+        return ValidationResult(filename, size, None, None, time.perf_counter() - start,
+                                '{}: {}'.format(type(e).__name__, e))
+    offset = section = None
+    if written != original:
+        offset = common_prefix(original, written)
+        section = section_at(filename, offset)
+    return ValidationResult(filename, size, offset, section, time.perf_counter() - start, None)
+
+def _quiet_worker():
+    # Workers must not race on the dump files or interleave the parsers'
+    # progress output.
+    global DUMP_DIR
+    DUMP_DIR = None
+    sys.stdout = open(os.devnull, 'w')
+
+def validate_directory(path, workers=None):
+    """Yield a ValidationResult for every .ess file in path, validated in
+    a process pool."""
+    filenames = sorted(os.path.join(path, name) for name in os.listdir(path)
+                       if name.lower().endswith('.ess'))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_quiet_worker) as pool:
+        for result in pool.map(validate_file, filenames, chunksize=4):
+            yield result
+
+
+def library_columns(filename):
+    """Per-save column data for export_library.
+
+    Only the change form headers are scanned; no record body is copied.
+    """
+    with LazySaveGame(filename) as savegame:
+        header = savegame.header
+        changeforms = savegame.changeforms
+        misc_stats = savegame.global_data_item('g1', 0)
+        save = dict(filename=filename,
+                    size=os.path.getsize(filename),
+                    playerName=header.playerName,
+                    playerLevel=header.playerLevel,
+                    playerLocation=header.playerLocation,
+                    saveNumber=header.saveNumber,
+                    version=header.version,
+                    formVersion=header.formVersion,
+                    filetime=header.filetime,
+                    changeFormCount=len(changeforms),
+                    pluginCount=len(savegame.plugins))
+        forms = dict(formid=changeforms.formids,
+                     type=changeforms.types,
+                     changeflags=changeforms.changeflags,
+                     version=changeforms.versions,
+                     length1=changeforms.length1,
+                     length2=changeforms.length2)
+        stats = list()
+        if misc_stats is not None:
+            for name, category, value in misc_stats[2]:
+                stats.append((StatCategoryNames.get(category, str(category)), name, value))
+        return save, forms, stats, list(savegame.plugins)
+
+def _try_library_columns(filename):
+    try:
+        return library_columns(filename)
+    except Exception as e:
+        log.warning("Can't read %s: %s", filename, e)
+        return None
+
+def _write_table(out, name, columns, format):
+    path = os.path.join(out, name + '.' + format)
+    if format == 'npz':
+        arrays = dict()
+        for key, values in columns.items():
+            if isinstance(values, array):
+                arrays[key] = numpy.frombuffer(values, dtype=values.typecode)
+            elif values and isinstance(values[0], datetime.datetime):
+                arrays[key] = numpy.array(values, dtype='datetime64[us]')
+            else:
+                arrays[key] = numpy.array(values)
+        numpy.savez(path, **arrays)
+    else:
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(list(columns.keys()))
+            for row in zip(*columns.values()):
+                writer.writerow([v.decode('utf-8', 'replace') if isinstance(v, bytes) else v
+                                 for v in row])
+    return path
+
+def export_library(path, out, format='npz', workers=None):
+    """Export the saves in directory path as columnar tables in out.
+
+    Writes four tables: saves (one row per file), changeforms (one row per
+    change form header), misc_stats and plugins; the last three refer to
+    the saves table through their 'save' column. format is 'npz' (numpy
+    arrays, one per column) or 'csv'. Saves are read in a process pool.
+    """
+    if format == 'npz' and numpy is None:
+        raise ValueError("npz export needs numpy")
+    filenames = sorted(os.path.join(path, name) for name in os.listdir(path)
+                       if name.lower().endswith('.ess'))
+
+    saves = defaultdict(list)
+    forms = OrderedDict()
+    forms_save = array('I')
+    stats = defaultdict(list)
+    plugins = defaultdict(list)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_quiet_worker) as pool:
+        for result in pool.map(_try_library_columns, filenames, chunksize=4):
+            if result is None:
+                continue
+            save, form_columns, stat_rows, plugin_names = result
+            index = len(saves['filename'])
+            for key, value in save.items():
+                saves[key].append(value)
+            forms_save.extend([index] * save['changeFormCount'])
+            for key, values in form_columns.items():
+                if key not in forms:
+                    forms[key] = array(values.typecode)
+                forms[key].extend(values)
+            for category, name, value in stat_rows:
+                stats['save'].append(index)
+                stats['category'].append(category)
+                stats['name'].append(name)
+                stats['value'].append(value)
+            for load_index, name in enumerate(plugin_names):
+                plugins['save'].append(index)
+                plugins['index'].append(load_index)
+                plugins['name'].append(name)
+
+    os.makedirs(out, exist_ok=True)
+    forms_columns = OrderedDict([('save', forms_save)])
+    forms_columns.update(forms)
+    return [_write_table(out, 'saves', saves, format),
+            _write_table(out, 'changeforms', forms_columns, format),
+            _write_table(out, 'misc_stats', stats, format),
+            _write_table(out, 'plugins', plugins, format)]
+
+
 if __name__ == '__main__':
 #    with open('Tes') as f:
 #        res = parse_tes(f, 1312, 'tt')
@@ -944,20 +2832,51 @@ if __name__ == '__main__':
     logging.basicConfig(stream=sys.stderr, level=loglevel)
 
     log.info(options.verbose)
+    strings = None
     if options.stringsfile:
-        strings = StringStore()
-        for f in options.stringsfile:
-            strings.load_file(f)
-
-        sys.exit(9)
+        key = hashlib.sha1('\0'.join(os.path.abspath(f) for f in options.stringsfile).encode('utf-8'))
+        strings = StringStore.cached(options.stringsfile,
+                                     os.path.join(default_cache_dir(), 'strings-{}.bin'.format(key.hexdigest())))
+        log.info('Loaded {} strings from {} files'.format(len(strings), len(options.stringsfile)))
+        if not options.essfile and not options.library:
+            sys.exit(0)
+
+    if options.validate:
+        started = time.perf_counter()
+        total = failed = 0
+        results = list()
+        for result in validate_directory(options.validate):
+            total += result.size
+            if result.error:
+                failed += 1
+                print('ERROR {}: {}'.format(result.filename, result.error))
+            elif result.offset is not None:
+                failed += 1
+                print('DIFF  {}: first difference at 0x{:x} in {}'.format(
+                    result.filename, result.offset, result.section))
+            else:
+                print('OK    {}'.format(result.filename))
+            results.append(result)
+        seconds = time.perf_counter() - started
+        print('{} files, {} failed, {:.1f} MB in {:.2f} s ({:.1f} MB/s)'.format(
+            len(results), failed, total / 1e6, seconds, total / 1e6 / seconds if seconds else 0))
+        sys.exit(1 if failed else 0)
+
+    if options.library:
+        if options.export:
+            for path in export_library(options.library, options.export, options.export_format):
+                print(path)
+        sys.exit(0)
 
     if options.header_only:
         print((get_header(options.essfile)))
         sys.exit(0)
 
-    savegame = load(options.essfile, options.image)
+    savegame = load(options.essfile, options.image, lazy=options.lazy)
     #print((savegame.gameheader))
     if options.essfile2:
+        if options.lazy:
+            savegame = savegame.savegame()
         savegame2 = load(options.essfile2, False)
         diff_item(savegame, savegame2)
 
@@ -969,21 +2888,41 @@ if __name__ == '__main__':
             print(p)
 
     print(("%s change records found" % len(savegame.changeforms)))
+
+    if options.orphans:
+        if options.lazy:
+            papyrus = savegame.global_data_item('g3', 1001)
+        else:
+            papyrus = next((item for item in savegame.g3.values() if item[1] == 1001), None)
+        if papyrus is None or not isinstance(papyrus[2], Papyrus):
+            print('No Papyrus data found')
+        else:
+            for instance in papyrus[2].orphaned_instances():
+                print(instance)
     #print((sorted(set([FormTypes[r.type][0] for r in savegame.changeforms]))))
 
-    if options.list_records:
-        for r in savegame.changeforms:
-            if FormTypes[r.type][0] == options.list_records:
-                print(r)
-                with open(options.list_records, 'wb') as f:
-                    f.write(r.data)
+    resolver = None
+    if strings is not None and options.form_strings:
+        resolver = NameResolver(strings, load_form_strings(options.form_strings))
 
-                print((parse_record(io.StringIO(r.data))))
+    if options.list_records:
+        positions = savegame.changeforms.positions_of_type(FormTypeIds.get(options.list_records))
+        names = resolver.resolve_changeforms(savegame, positions) if resolver else [None] * len(positions)
+        for index, name in zip(positions, names):
+            r = savegame.changeforms[index]
+            if name is not None:
+                print(name.decode('utf-8', 'replace'))
+            print(r)
+            with open(options.list_records, 'wb') as f:
+                f.write(r.data)
     #print '-----------------------------------------------'
 
     if options.write_to:
         print((savegame.gameheader.filetime))
-        write(savegame, options.write_to)
+        if options.lazy:
+            write_patched(savegame, options.write_to)
+        else:
+            write(savegame, options.write_to)
 
     #log.info('BLUU {} {:X}'.format(size, nextObjectId))
     #print 'Done.'
@@ -991,6 +2930,8 @@ if __name__ == '__main__':
 
     if options.verbose:
         pprint.pprint((savegame.g1.get('Misc Stats')))
+        if resolver:
+            pprint.pprint(resolver.resolve_globals(savegame))
 
     if options.verbose:
         pprint.pprint(savegame.g1)
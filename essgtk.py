@@ -1,21 +1,34 @@
 #!/usr/bin/python
 
-import array
-from collections import defaultdict
-import glob
+from collections import defaultdict, OrderedDict
+import hashlib
+import logging
 import operator
 import os
+import threading
 import time
 import sys
 import pprint
 from io import BytesIO
 
-from gi.repository import Gtk
+from gi.repository import Gdk, Gtk
 
 import cairo
+from PIL import Image
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import essedit5
 
+THUMBNAIL_SIZE = (480, 270)
+# Least recently used thumbnails beyond this many are removed at startup.
+THUMBNAIL_CACHE_COUNT = 2000
+# Opened saves kept with their screenshot surface; each holds an mmap.
+OPEN_SAVES = 8
+
 class IdTreeIter(Gtk.TreeIter):
     def __init__(self):
         Gtk.TreeIter.__init__(self)
@@ -26,8 +39,11 @@ class Handler:
         self.drawingarea = builder.get_object('screenshot_da')
         self.statusbar = builder.get_object('statusbar')
         self.tv = builder.get_object('textview1')
+        self.treeview = builder.get_object('essfile_treeview')
+        self.treeview.set_has_tooltip(True)
+        self.treeview.connect('query-tooltip', self.on_treeview_tooltip)
 
-        self.savegames = dict()
+        self.savegames = OrderedDict() # least recently shown first
         self.current_savegame = None
         self.current_surface = None
 
@@ -63,25 +79,17 @@ class Handler:
         ctx.set_source_surface(surface, 0,0)
         ctx.paint()
 
-    def prepare_surface(self):
-        width, height, rgb_data = self.current_savegame.gameheader.screenshot
-        data = array.array('B', [0] * width * height * 4)
-
-        for y in range(height):
-            for x in range(width):
-                offset = (x + (y * width)) * 4
-                rgb_offset = (x + (y * width)) * 3
-                alpha = 0
-
-                data[offset+0] = rgb_data[rgb_offset+2]
-                data[offset+1] = rgb_data[rgb_offset+1]
-                data[offset+2] = rgb_data[rgb_offset+0]
-                data[offset+3] = 0
-
-        surface = cairo.ImageSurface.create_for_data(data,
-                                                     cairo.FORMAT_RGB24,
-                                                     width, height)
-        return surface
+    def on_treeview_tooltip(self, treeview, x, y, keyboard_mode, tooltip):
+        found, x, y, model, path, treeiter = treeview.get_tooltip_context(x, y, keyboard_mode)
+        if not found or not model[treeiter][3]:
+            return False
+        surface = thumbnail_surface(model[treeiter][3])
+        if surface is None:
+            return False # not generated yet
+        tooltip.set_icon(Gdk.pixbuf_get_from_surface(surface, 0, 0, surface.get_width(),
+                                                     surface.get_height()))
+        treeview.set_tooltip_row(tooltip, path)
+        return True
 
     def show_details(self, selection):
         model, treeiter = selection.get_selected()
@@ -89,12 +97,14 @@ class Handler:
         if not filename:
             return
 
-        self.current_savegame, self.current_surface = self.savegames.get(filename, (None, None))
+        self.current_savegame, self.current_surface = self.savegames.pop(filename, (None, None))
         if not self.current_savegame:
-            self.current_savegame = essedit5.load(filename)
-            self.current_surface = self.prepare_surface()
-            print(type(self.current_savegame))
-            self.savegames[filename] = self.current_savegame, self.current_surface
+            self.current_savegame = essedit5.load(filename, lazy=True)
+            self.current_surface = rgb_to_surface(*self.current_savegame.gameheader.screenshot)
+        self.savegames[filename] = self.current_savegame, self.current_surface
+        while len(self.savegames) > OPEN_SAVES:
+            savegame, surface = self.savegames.popitem(last=False)[1]
+            savegame.close()
 
         self.draw_screenshot(self.drawingarea)
         self.current_statdict = self.current_savegame.g1
@@ -108,12 +118,102 @@ class Handler:
 
     def on_destroy(self, *args):
         print(args)
+        for savegame, surface in self.savegames.values():
+            savegame.close()
+        self.savegames.clear()
         Gtk.main_quit(*args)
 
 
-def get_files(path):
-    files = glob.glob(os.path.join(path, '*.ess'))
-    return sorted(files)
+def rgb_to_surface(width, height, rgb_data):
+    """Copy packed RGB pixels into a new cairo RGB24 (BGRX in memory) surface."""
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+    stride = surface.get_stride()
+    buf = surface.get_data()
+    if numpy is not None:
+        src = numpy.frombuffer(rgb_data, dtype=numpy.uint8, count=3*width*height)
+        src = src.reshape(height, width, 3)
+        dst = numpy.ndarray((height, stride // 4, 4), dtype=numpy.uint8, buffer=buf)
+        dst[:, :width, :3] = src[:, :, ::-1]
+        dst[:, :width, 3] = 0
+    else:
+        im = Image.frombuffer('RGB', (width, height), rgb_data, 'raw', 'RGB', 0, 1)
+        bgrx = im.tobytes('raw', 'BGRX', stride)
+        buf[:len(bgrx)] = bgrx
+    surface.mark_dirty()
+    return surface
+
+
+def thumbnail_path(filename):
+    st = os.stat(filename)
+    key = '%s:%d:%d' % (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.png'
+    return os.path.join(essedit5.default_cache_dir(), 'thumbnails', name)
+
+
+def thumbnail_surface(filename):
+    """The cached thumbnail of filename as a surface, or None if it has
+    not been generated yet."""
+    path = thumbnail_path(filename)
+    if not os.path.exists(path):
+        return None
+    os.utime(path)
+    return cairo.ImageSurface.create_from_png(path)
+
+
+def make_thumbnail(filename):
+    """Write the downscaled screenshot of filename to the thumbnail cache,
+    unless it is there already."""
+    path = thumbnail_path(filename)
+    if os.path.exists(path):
+        return
+    with essedit5.LazySaveGame(filename) as savegame:
+        width, height, rgb_data = savegame.gameheader.screenshot
+        im = Image.frombuffer('RGB', (width, height), rgb_data, 'raw', 'RGB', 0, 1)
+        im.thumbnail(THUMBNAIL_SIZE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written under another name first so the UI never reads a partial PNG.
+    tmp = '%s.%d.png' % (path[:-4], os.getpid())
+    im.save(tmp)
+    os.replace(tmp, path)
+
+
+def start_thumbnails(filenames):
+    """Generate the missing thumbnails of filenames in a background thread.
+
+    Only the files are touched there; tooltips pick the thumbnails up from
+    the cache once they exist.
+    """
+    def work():
+        for filename in filenames:
+            try:
+                make_thumbnail(filename)
+            except Exception as e:
+                logging.warning("Can't make a thumbnail of %s: %s", filename, e)
+
+    thread = threading.Thread(target=work)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def prune_thumbnails(keep=THUMBNAIL_CACHE_COUNT):
+    """Remove all but the keep most recently used cached thumbnails.
+
+    Thumbnails of saves that were deleted or changed are never used again,
+    so they are the ones that age out.
+    """
+    directory = os.path.join(essedit5.default_cache_dir(), 'thumbnails')
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    paths = [os.path.join(directory, name) for name in names if name.endswith('.png')]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for path in paths[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
 
 if __name__ == '__main__':
@@ -124,12 +224,13 @@ if __name__ == '__main__':
     builder.connect_signals(h)
     h.statusbar.push(h.statusbar.get_context_id('foo'), 'Loading...')
     t = time.time()
+    prune_thumbnails()
 
     items = defaultdict(list)
     treestore = builder.get_object('essfile_treestore')
-    files = get_files('./ess5')
-    for f in files:
-        header = essedit5.get_header(f)
+    files = essedit5.scan_headers('./ess5')
+    start_thumbnails([f for f, header in files])
+    for f, header in files:
         character = header.playerName.decode(sys.stdout.encoding)
         items[character].append(dict(location=header.playerLocation.decode(sys.stdout.encoding),
                                      filename=f,
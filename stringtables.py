@@ -1,5 +1,18 @@
+from array import array
+from bisect import bisect_left
+import heapq
+from itertools import groupby
+import json
+import mmap
+from operator import itemgetter
+import os
 import sys
-from struct import unpack, pack, error
+from struct import unpack, unpack_from, pack, error
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def parse_b_or_bzstring(filehandle, bz=False):
     # A string prefixed with a byte length and optionally terminated with a zero (\x00).
@@ -11,9 +24,15 @@ def parse_b_or_bzstring(filehandle, bz=False):
         return s
 
 class StringsFile(object):
-    def __init__(self, filename):
+    """A .STRINGS, .DLSTRINGS or .ILSTRINGS table.
+
+    With lazy=True the file is memory-mapped and only the directory is
+    read, into id-sorted array('I')s of ids and offsets; a string is
+    sliced out of the map when it is looked up.
+    """
+    def __init__(self, filename, lazy=False):
         self.filename = filename
-        filetype = filename.split('.')[-1]
+        filetype = filename.split('.')[-1].upper()
         if filetype in ['DLSTRINGS', 'ILSTRINGS']:
             self.use_length_prefix = True
         elif filetype in ['STRINGS']:
@@ -21,6 +40,13 @@ class StringsFile(object):
         else:
             print("Unknown filetype %r." % filetype)
 
+        self.lazy = lazy
+        if lazy:
+            with open(self.filename, 'rb') as sf:
+                self._map = mmap.mmap(sf.fileno(), 0, access=mmap.ACCESS_READ)
+            self._map_offsets()
+            return
+
         self.id_to_offset = dict()
         self.id_to_string = dict()
         self.offset_to_string = dict()
@@ -38,6 +64,61 @@ class StringsFile(object):
             self.id_to_offset[string_id] = offset
         self.data_begin = sf.tell()
 
+    def _map_offsets(self):
+        self.string_count, self.size = unpack_from('<II', self._map, 0)
+        self.data_begin = 8 + 8 * self.string_count
+        directory = array('I')
+        directory.frombytes(self._map[8:self.data_begin])
+        if sys.byteorder == 'big':
+            directory.byteswap()
+        ids, offsets = directory[0::2], directory[1::2]
+        if any(a >= b for a, b in zip(ids, ids[1:])):
+            if numpy is not None:
+                order = numpy.argsort(numpy.frombuffer(ids, dtype=numpy.uint32), kind='stable')
+                ids = array('I', numpy.frombuffer(ids, dtype=numpy.uint32)[order].tobytes())
+                offsets = array('I', numpy.frombuffer(offsets, dtype=numpy.uint32)[order].tobytes())
+            else:
+                pairs = sorted(zip(ids, offsets))
+                ids = array('I', [i for i, o in pairs])
+                offsets = array('I', [o for i, o in pairs])
+        self.ids = ids
+        self.offsets = offsets
+
+    def _map_string(self, offset):
+        start = self.data_begin + offset
+        if self.use_length_prefix:
+            length, = unpack_from('<I', self._map, start)
+            return self._map[start+4:start+3+length]
+        # An unterminated last string runs to the end of the data block,
+        # as in _read_string().
+        end = min(self.data_begin + self.size, len(self._map))
+        nul = self._map.find(b'\0', start, end)
+        return self._map[start:end if nul < 0 else nul]
+
+    def get(self, string_id, default=None):
+        if not self.lazy:
+            return self.id_to_string.get(string_id, default)
+        i = bisect_left(self.ids, string_id)
+        if i == len(self.ids) or self.ids[i] != string_id:
+            return default
+        return self._map_string(self.offsets[i])
+
+    def __len__(self):
+        return self.string_count
+
+    def __contains__(self, string_id):
+        return self.get(string_id) is not None
+
+    def items(self):
+        if not self.lazy:
+            return iter(self.id_to_string.items())
+        return ((string_id, self._map_string(offset))
+                for string_id, offset in zip(self.ids, self.offsets))
+
+    def close(self):
+        if self.lazy:
+            self._map.close()
+
     def _read_string(self, sf, offset):
         sf.seek(self.data_begin + offset)
         if self.use_length_prefix:
@@ -48,21 +129,194 @@ class StringsFile(object):
             chars = list()
             while not_finished:
                 ch = sf.read(1)
-                if ch == '\0':
+                if ch in (b'\0', b''):
                     not_finished = False
                 else:
                     chars.append(ch)
-            return ''.join(chars)
+            return b''.join(chars)
+
+
+def _tagged(source, ids):
+    for i, string_id in enumerate(ids):
+        yield string_id, source, i
+
+
+def default_cache_dir():
+    """The essedit directory in the user cache directory."""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'essedit')
 
 
 class StringStore(object):
+    """The strings of several tables, by id.
+
+    All strings are kept in one bytes blob in id order, with array('I')
+    columns of the sorted ids and of the blob offsets (one more than
+    there are ids). A store can be saved as a compiled cache file and
+    memory-mapped from it again with StringStore.open().
+    """
+    CACHE_MAGIC = b'ESSTRS01'
+
     def __init__(self):
-        self.strings = dict()
-        self.ids = set()
+        self.ids = array('I')
+        self.offsets = array('I', [0])
+        self.blob = b''
+        self.sources = list()
+        self._map = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, string_id):
+        return self._index(string_id) is not None
+
+    def _index(self, string_id):
+        i = bisect_left(self.ids, string_id)
+        if i == len(self.ids) or self.ids[i] != string_id:
+            return None
+        return i
+
+    def items(self):
+        blob, offsets = self.blob, self.offsets
+        return ((string_id, bytes(blob[offsets[i]:offsets[i+1]]))
+                for i, string_id in enumerate(self.ids))
 
     def load_file(self, filename):
-        sf = StringsFile(filename)
-        self.strings.update(sf.id_to_string)
+        self.load_files([filename])
+
+    def load_files(self, filenames):
+        """Adds the strings of filenames; later files win on equal ids.
+
+        The id-sorted directories of the store and of the memory-mapped
+        files are merged straight into new columns and blob, so the
+        strings are only held once, in the result.
+        """
+        files = list()
+        try:
+            for filename in filenames:
+                files.append(StringsFile(filename, lazy=True))
+            # (id, source, position); source 0 is the store itself.
+            columns = [self.ids] + [sf.ids for sf in files]
+            streams = [_tagged(source, ids) for source, ids in enumerate(columns)]
+            ids = array('I')
+            offsets = array('I', [0])
+            blob = bytearray()
+            for string_id, entries in groupby(heapq.merge(*streams), itemgetter(0)):
+                for string_id, source, i in entries:
+                    pass # the last entry is from the latest source
+                if source:
+                    sf = files[source-1]
+                    blob += sf._map_string(sf.offsets[i])
+                else:
+                    blob += self.blob[self.offsets[i]:self.offsets[i+1]]
+                ids.append(string_id)
+                offsets.append(len(blob))
+        finally:
+            for sf in files:
+                sf.close()
+        self.close()
+        self.ids, self.offsets, self.blob = ids, offsets, blob
+        self.sources.extend(file_stamp(filename) for filename in filenames)
+
+    def lookup_string(self, string_id):
+        i = self._index(string_id)
+        if i is None:
+            return None
+        return bytes(self.blob[self.offsets[i]:self.offsets[i+1]])
+
+    def lookup_strings(self, string_ids):
+        """lookup_string for every id in string_ids, in one searchsorted
+        pass when numpy is available."""
+        if numpy is None or not len(self.ids):
+            return [self.lookup_string(string_id) for string_id in string_ids]
+        ids = numpy.frombuffer(self.ids, dtype=numpy.uint32)
+        wanted = numpy.asarray(string_ids, dtype=numpy.uint32)
+        positions = numpy.searchsorted(ids, wanted)
+        positions[positions == len(ids)] = 0
+        found = ids[positions] == wanted
+        blob, offsets = self.blob, self.offsets
+        return [bytes(blob[offsets[i]:offsets[i+1]]) if ok else None
+                for i, ok in zip(positions.tolist(), found.tolist())]
+
+    def save(self, filename):
+        """Writes the store as a compiled cache file."""
+        sources = json.dumps(self.sources).encode('utf-8')
+        sources += b' ' * (-len(sources) % 4)
+        ids, offsets = self.ids, self.offsets
+        if sys.byteorder == 'big':
+            ids, offsets = array('I', ids), array('I', offsets)
+            ids.byteswap()
+            offsets.byteswap()
+        tmp = filename + '.%d' % os.getpid()
+        with open(tmp, 'wb') as f:
+            f.write(self.CACHE_MAGIC)
+            f.write(pack('<II', len(sources), len(self.ids)))
+            f.write(sources)
+            f.write(ids.tobytes())
+            f.write(offsets.tobytes())
+            f.write(self.blob)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def open(cls, filename):
+        """A store memory-mapped from a cache file written by save()."""
+        store = cls()
+        with open(filename, 'rb') as f:
+            store._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = store._map
+        if data[:8] != cls.CACHE_MAGIC:
+            store.close()
+            raise ValueError('Not a string cache: %r' % filename)
+        sources_size, count = unpack_from('<II', data, 8)
+        start = 16 + sources_size
+        store.sources = [tuple(source) for source in json.loads(data[16:start].decode('utf-8'))]
+        view = memoryview(data)
+        ids = view[start:start+4*count]
+        offsets = view[start+4*count:start+8*count+4]
+        if sys.byteorder == 'big':
+            store.ids, store.offsets = array('I', ids.tobytes()), array('I', offsets.tobytes())
+            store.ids.byteswap()
+            store.offsets.byteswap()
+        else:
+            store.ids, store.offsets = ids.cast('I'), offsets.cast('I')
+        store.blob = view[start+8*count+4:]
+        return store
+
+    @classmethod
+    def cached(cls, filenames, cache_file):
+        """A store of filenames, from cache_file while it is up to date
+        with them, otherwise loaded and saved there."""
+        stamps = [file_stamp(filename) for filename in filenames]
+        try:
+            store = cls.open(cache_file)
+        except (IOError, OSError, ValueError):
+            store = None
+        if store is not None:
+            if store.sources == stamps:
+                return store
+            store.close()
+        store = cls()
+        store.load_files(filenames)
+        try:
+            directory = os.path.dirname(cache_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            store.save(cache_file)
+        except OSError:
+            pass # the cache is only an optimization
+        return store
+
+    def close(self):
+        if self._map is not None:
+            for name in ('ids', 'offsets', 'blob'):
+                view = getattr(self, name)
+                if isinstance(view, memoryview):
+                    view.release()
+            self.ids, self.offsets, self.blob = array('I'), array('I', [0]), b''
+            self._map.close()
+            self._map = None
+
 
-    def lookup_string(string_id):
-        return self.strings.get(string_id)
+def file_stamp(filename):
+    st = os.stat(filename)
+    return (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
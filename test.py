@@ -6,8 +6,8 @@ import essedit5
 
 with open('SkyCells', 'rb') as fh:
     data = fh.read()
-    print(essedit5.parse_skycells(io.BytesIO(data), len(data), 'SkyCells'))
+    print(essedit5.parse_skycells(essedit5.Reader(data), len(data), 'SkyCells'))
 
 with open('Interface', 'rb') as fh:
    data = fh.read()
-   print(essedit5.parse_interface(io.BytesIO(data), len(data), 'Interface'))
+   print(essedit5.parse_interface(essedit5.Reader(data), len(data), 'Interface'))